@@ -1,7 +1,7 @@
 import discord
 from discord import app_commands
 from io import BytesIO
-from klunk import sandbox
+from klunk import dataset, sandbox
 from klunk.language import ParseError
 from klunk.match import NON_ABNORMAL_PLAYERS
 
@@ -157,7 +157,7 @@ def get_warns(uid: int):
     global WARNS_ETC
     if uid not in WARNS_ETC:
         WARNS_ETC.add(uid)
-        return '\n*All seasons have been removed except for the current season due to extreme memory issues. Modifications to use a SQL backend and support all seasons again are in progress, no ETA. Sorry!*\n'
+        return '\n*Older seasons are back! They are loaded from disk when a query needs them (e.g. `index s1`), so those queries can be slower.*\n'
         # return '\n**Important note:** Ranked matches from seasons 0, 1, 2, and 3 are NO LONGER available in the discord bot dataset. (Excepting playoff matches, which are still loaded.) I still have this data and will start loading it again if/when I rewrite the bot to not consume 15gb of data...\n**Other updates:** The "category" key/value pair is now available in match data.\n'
     return ''
 
@@ -486,6 +486,23 @@ def run_cli():
 
 
 def main(args):
+    if "--load-workers" in args:
+        # Parse group files on N processes at startup.
+        dataset.LOAD_WORKERS = int(args[args.index("--load-workers") + 1])
+
+    if "--partition-budget" in args:
+        # Most matches from old (on-demand) seasons to keep in memory.
+        dataset.PARTITION_BUDGET = int(args[args.index("--partition-budget") + 1])
+
+    if "--cache-dir" in args:
+        # Where the snapshot, journal and season partitions go (default: next to the group files).
+        dataset.CACHE_DIR = args[args.index("--cache-dir") + 1].rstrip("/") + "/"
+    elif "--fake" in args:
+        # Don't leave anything next to the samples, or the next run picks it up.
+        import tempfile
+
+        dataset.CACHE_DIR = tempfile.mkdtemp(prefix="rql-") + "/"
+
     if "--preload" in args:
         print("Preloading all loadable data into engine.")
         sandbox.Query("+debug timing tb | testlog 'Preloaded data.'").run()
@@ -0,0 +1,559 @@
+"""
+Benchmarks for the slow parts of the bot.
+Run with `python -m klunk.bench [names...] [--scale N] [--rate N]` from the repository root.
+With no names, runs everything. Most of these scale up the sample data first,
+as the samples alone load far too quickly to say anything useful.
+"""
+import inspect
+import json
+import os
+import sys
+import tempfile
+import time
+
+from .dataset import Dataset
+
+bench_registry = dict()
+
+
+def Bench(f):
+    bench_registry[f.__name__] = f
+    return f
+
+
+def timed(f, *args, **kwargs):
+    now = time.time()
+    res = f(*args, **kwargs)
+    return res, time.time() - now
+
+
+def report(title: str, rows: list[tuple]):
+    print(f"=== {title} ===")
+    for row in rows:
+        print("  " + " | ".join([str(x) for x in row]))
+
+
+def scaled_samples(dest: str, factor: int, src="klunk/samples/"):
+    """
+    Writes `factor` copies of the sample group files into dest.
+    Every copy gets its match ids shifted into a fresh range, so the result
+    loads like one long history. Seasons are shifted past the seasons that
+    get_skip_rule drops (the samples are all s0-s2), otherwise a scaled up
+    dataset would load as nothing at all.
+    """
+    from .dataset import default_groups
+
+    for copy in range(factor):
+        offset = copy * 1000000
+        for g in default_groups(src):
+            lo, hi = [int(x) for x in g[: -len(".txt")].split("-")]
+            with open(f"{src}{g}") as infile, open(f"{dest}{lo + offset}-{hi + offset}.txt", "w") as outfile:
+                for l in infile:
+                    m = json.loads(l)
+                    m["match_id"] += offset
+                    m["match_season"] += 8 + copy // 4
+                    outfile.write(json.dumps(m))
+                    outfile.write("\n")
+    return dest
+
+
+def tournament_matches(count: int, seed=0):
+    """
+    A fake history that is mostly playoffs: bursts of private, spectated
+    matches between the same pairs, the first of each burst tagged, with
+    ranked matches in between. Built from copies of the sample matches.
+    """
+    import copy
+    import random
+    from .dataset import load_raw_matches
+
+    rng = random.Random(seed)
+    samples = load_raw_matches("klunk/samples/", quiet=True)
+    pairs = [m for m in samples if len(m.members) == 2]
+    res = list()
+    while len(res) < count:
+        pair = rng.choice(pairs)
+        tag = rng.choice([None, "playoffs", "tournament"])
+        for game in range(rng.randint(1, 5)):
+            m = copy.copy(pair)
+            m.type, m.spectated, m.members = 3, True, pair.members
+            m.tag = tag if game == 0 else None
+            res.append(m)
+            res.extend([copy.copy(rng.choice(samples)) for _ in range(rng.randint(0, 3))])
+    date = samples[0].date
+    for i, m in enumerate(res):
+        m.id = i
+        m.date = date
+        date += rng.randint(30, 600)
+    return res
+
+
+def cleanup_matches_scan(l):
+    # The old cleanup_matches, which scans an hour either way around every tagged match.
+    ONE_HOUR = 60 * 60
+    for i, m in enumerate(l):
+        if m.type == 3 and m.spectated and m.tag is not None:
+            loc = i
+            while loc > 0:
+                loc -= 1
+                pm = l[loc]
+                if (m.date - pm.date) > ONE_HOUR:
+                    break
+                if pm.type != 3 or not pm.spectated or pm.tag is not None:
+                    continue
+                if pm.members == m.members:
+                    pm.tag = m.tag
+            loc = i
+            while loc < len(l) - 1:
+                loc += 1
+                pm = l[loc]
+                if (pm.date - m.date) > ONE_HOUR:
+                    break
+                if pm.type != 3 or not pm.spectated or pm.tag is not None:
+                    continue
+                if pm.members == m.members:
+                    pm.tag = m.tag
+    return l
+
+
+@Bench
+def snapshot(scale=20):
+    from .dataset import SNAPSHOT_NAME, load_matches
+
+    with tempfile.TemporaryDirectory() as tmp:
+        d = scaled_samples(f"{tmp}/", scale)
+        (cold, _, _), cold_time = timed(load_matches, d, True)
+        snapsize = os.path.getsize(f"{d}{SNAPSHOT_NAME}")
+        (warm, _, _), warm_time = timed(load_matches, d, True)
+        assert len(cold) == len(warm)
+        report(
+            f"snapshot: {len(cold)} matches",
+            [
+                ("json (cold, includes writing the snapshot)", f"{cold_time:.3f}s"),
+                ("snapshot (warm)", f"{warm_time:.3f}s"),
+                ("speedup", f"{cold_time / warm_time:.1f}x"),
+                ("snapshot size", f"{snapsize // 1024} KiB"),
+            ],
+        )
+
+
+@Bench
+def load_workers(scale=20):
+    from .dataset import load_raw_matches
+
+    counts = [1, 2, 4, 8]
+    with tempfile.TemporaryDirectory() as tmp:
+        d = scaled_samples(f"{tmp}/", scale)
+        # Untimed serial pass first: it runs any pending dyn.py queries, which would otherwise force serial loading.
+        expected = [m.to_row() for m in load_raw_matches(d, True)]
+        rows = []
+        base = None
+        for workers in counts:
+            res, t = timed(load_raw_matches, d, True, workers=workers)
+            assert [m.to_row() for m in res] == expected
+            base = base or t
+            rows.append((f"{workers} worker(s)", f"{t:.3f}s", f"{base / t:.2f}x"))
+        report(f"load_raw_matches: {len(expected)} matches, {os.cpu_count()} cpu(s)", rows)
+
+
+@Bench
+def memory(scale=20):
+    import gc
+    import tracemalloc
+    from .dataset import load_raw_matches
+    from .store import STORE
+
+    with tempfile.TemporaryDirectory() as tmp:
+        d = scaled_samples(f"{tmp}/", scale)
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        res = load_raw_matches(d, True)
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        report(
+            f"memory: {len(res)} matches",
+            [
+                ("total", f"{(after - before) // 1024} KiB"),
+                ("per match", f"{(after - before) // len(res)} B"),
+                ("of which match store columns", f"{STORE.nbytes() // len(res)} B"),
+            ],
+        )
+
+
+@Bench
+def cleanup(scale=20):
+    from .dataset import cleanup_matches
+
+    l = tournament_matches(scale * 5000)
+    tags = [m.tag for m in l]
+    rows = []
+    results = []
+    for name, f in (("scan (old)", cleanup_matches_scan), ("hour buckets", cleanup_matches)):
+        for m, tag in zip(l, tags):
+            m.tag = tag
+        _, t = timed(f, l)
+        results.append([m.tag for m in l])
+        rows.append((name, f"{t:.3f}s"))
+    assert results[0] == results[1]
+    tagged = len([t for t in results[0] if t is not None])
+    report(f"cleanup_matches: {len(l)} matches, {tagged} tagged after cleanup", rows)
+
+
+@Bench
+def postings(scale=20):
+    from .dataset import ROOT_INDEXES, GetUserMappings, build_indexes, load_raw_matches
+    from .language import Compiler, Tokenizer
+    from .runtime import Runtime
+
+    with tempfile.TemporaryDirectory() as tmp:
+        l = load_raw_matches(scaled_samples(f"{tmp}/", scale), True)
+    uuids, users = GetUserMappings(l)
+    player = max(users.keys(), key=lambda u: len([m for m in l[:5000] if m.members.get(users[u])]))
+    rows = []
+    results = []
+    for name in ("scan", "postings"):
+        datasets = {n: Dataset(n, idx, root=True) for n, idx in build_indexes(ROOT_INDEXES, l, l[-1].season).items()}
+        if name == "postings":
+            _, t = timed(lambda: [d.index_players() for d in datasets.values()])
+            rows.append(("building postings (all root indexes)", f"{t:.3f}s"))
+        datasets["__uuids"], datasets["__users"] = Dataset("UUIDs", uuids), Dataset("Users", users)
+        rt = Runtime(datasets=datasets, commands=dict())
+        for q in (f"index all | filter uuid({player}) | extract id", f"index all | filter winner({player}) | extract id"):
+            res, t = timed(lambda: rt.execute(*Compiler().compile(Tokenizer().tokenize(q), source=q)).l)
+            results.append(res)
+            rows.append((f"{name}: {q}", f"{t * 1000:.1f}ms", f"{len(res)} matches"))
+    assert results[:2] == results[2:]
+    report(f"postings: {len(l)} matches", rows)
+
+
+@Bench
+def extractors(scale=20):
+    from . import runtime
+    from .dataset import ROOT_INDEXES, GetUserMappings, build_indexes, load_raw_matches
+    from .language import Compiler, Tokenizer
+
+    with tempfile.TemporaryDirectory() as tmp:
+        l = load_raw_matches(scaled_samples(f"{tmp}/", scale), True)
+    uuids, users = GetUserMappings(l)
+    datasets = {n: Dataset(n, idx, root=True) for n, idx in build_indexes(ROOT_INDEXES, l, l[-1].season).items()}
+    datasets["__uuids"], datasets["__users"] = Dataset("UUIDs", uuids), Dataset("Users", users)
+    queries = [
+        "index all | sort duration | take 1",
+        "index all | filter completed seed_type(village) | count",
+        "index all | extract id duration winner | count",
+    ]
+
+    def run(q):
+        rt = runtime.Runtime(datasets=datasets, commands=dict())
+        return rt.execute(*Compiler().compile(Tokenizer().tokenize(q), source=q))
+
+    run(queries[0])
+    rows = []
+    results = []
+    direct = runtime.DIRECT_EXTRACT
+    for name, types in (("extract()", dict()), ("direct", direct)):
+        runtime.DIRECT_EXTRACT = types
+        runtime.EXTRACTORS.clear()
+        try:
+            for q in queries:
+                res, t = timed(run, q)
+                results.append(None if res is None else res.l)
+                rows.append((f"{name}: {q}", f"{t * 1000:.1f}ms"))
+        finally:
+            runtime.DIRECT_EXTRACT = direct
+            runtime.EXTRACTORS.clear()
+    assert results[: len(queries)] == results[len(queries) :]
+    report(f"extractors: {len(l)} matches", rows)
+
+
+@Bench
+def sorted_take(scale=20):
+    from . import runtime
+    from .dataset import ROOT_INDEXES, GetUserMappings, build_indexes, load_raw_matches
+    from .language import Compiler, Tokenizer
+
+    with tempfile.TemporaryDirectory() as tmp:
+        l = load_raw_matches(scaled_samples(f"{tmp}/", scale), True)
+    uuids, users = GetUserMappings(l)
+    datasets = {n: Dataset(n, idx, root=True) for n, idx in build_indexes(ROOT_INDEXES, l, l[-1].season).items()}
+    datasets["__uuids"], datasets["__users"] = Dataset("UUIDs", uuids), Dataset("Users", users)
+    queries = ["index all | sort duration | take 10", "index all | rsort date | take last 10", "index all | sort seed_type | take 10"]
+
+    def run(q):
+        rt = runtime.Runtime(datasets=datasets, commands=dict())
+        return rt.execute(*Compiler().compile(Tokenizer().tokenize(q), source=q)).l
+
+    run(queries[0])
+    rows = []
+    results = []
+    fuse = runtime.sorted_take
+    for name, f in (("sort everything", lambda e, after: None), ("top n", fuse)):
+        runtime.sorted_take = f
+        try:
+            for q in queries:
+                times = [timed(run, q) for _ in range(5)]
+                results.append(times[0][0])
+                rows.append((f"{name}: {q}", f"{min([t for _, t in times]) * 1000:.1f}ms (best of 5)"))
+        finally:
+            runtime.sorted_take = fuse
+    assert results[: len(queries)] == results[len(queries) :]
+    report(f"sorted_take: {len(l)} matches", rows)
+
+
+@Bench
+def sort_orders(scale=20):
+    from .dataset import ROOT_INDEXES, GetUserMappings, build_indexes, load_raw_matches
+    from .language import Compiler, Tokenizer
+    from .runtime import Runtime
+
+    with tempfile.TemporaryDirectory() as tmp:
+        l = load_raw_matches(scaled_samples(f"{tmp}/", scale), True)
+    uuids, users = GetUserMappings(l)
+    queries = ["index all | sort duration | count", "index all | filter noff | rsort date | count", "index most | filter nodecay | sort id | count"]
+    rows = []
+    for name in ("sorted()", "kept orders"):
+        datasets = {n: Dataset(n, idx, root=True) for n, idx in build_indexes(ROOT_INDEXES, l, l[-1].season).items()}
+        if name == "kept orders":
+            for d in datasets.values():
+                d.keep_orders()
+        datasets["__uuids"], datasets["__users"] = Dataset("UUIDs", uuids), Dataset("Users", users)
+
+        def run(q):
+            rt = Runtime(datasets=datasets, commands=dict())
+            return rt.execute(*Compiler().compile(Tokenizer().tokenize(q), source=q))
+
+        for q in queries:
+            # The first run builds the order.
+            _, first = timed(run, q)
+            t = min([timed(run, q)[1] for _ in range(5)])
+            rows.append((f"{name}: {q}", f"first {first * 1000:.1f}ms", f"then {t * 1000:.1f}ms (best of 5)"))
+    report(f"sort_orders: {len(l)} matches", rows)
+
+
+@Bench
+def selection(scale=20):
+    from . import runtime
+    from .dataset import ROOT_INDEXES, GetUserMappings, build_indexes, load_raw_matches
+    from .language import Compiler, Tokenizer
+
+    with tempfile.TemporaryDirectory() as tmp:
+        l = load_raw_matches(scaled_samples(f"{tmp}/", scale), True)
+    uuids, users = GetUserMappings(l)
+    datasets = {n: Dataset(n, idx, root=True).keep_orders() for n, idx in build_indexes(ROOT_INDEXES, l, l[-1].season).items()}
+    datasets["__uuids"], datasets["__users"] = Dataset("UUIDs", uuids), Dataset("Users", users)
+    queries = [
+        "index all | filter noff | between duration 600000 900000 | count",
+        "index all | filter noff nodecay | rsort date | count",
+        "index all | filter noff | drop type 1 | sort duration | take 10",
+    ]
+
+    def run(q):
+        rt = runtime.Runtime(datasets=datasets, commands=dict())
+        rt.execute(*Compiler().compile(Tokenizer().tokenize(q), source=q))
+        return rt._result
+
+    rows = []
+    picking = runtime.SELECTION_COMMANDS
+    for q in queries:
+        results = []
+        for name, commands in (("lists", set()), ("selections", picking)):
+            runtime.SELECTION_COMMANDS = commands
+            try:
+                run(q)  # builds the orders
+                res, _ = timed(run, q)
+                t = min([timed(run, q)[1] for _ in range(5)])
+            finally:
+                runtime.SELECTION_COMMANDS = picking
+            results.append(res)
+            rows.append((f"{name}: {q}", f"{t * 1000:.1f}ms (best of 5)"))
+        assert results[0] == results[1], q
+    report(f"selection: {len(l)} matches", rows)
+
+
+@Bench
+def bitmaps(scale=20):
+    from . import runtime
+    from .dataset import ROOT_INDEXES, GetUserMappings, build_indexes, load_raw_matches
+    from .language import Compiler, Tokenizer
+
+    with tempfile.TemporaryDirectory() as tmp:
+        l = load_raw_matches(scaled_samples(f"{tmp}/", scale), True)
+    uuids, users = GetUserMappings(l)
+    queries = [
+        "index all | filter noff | count",
+        "index all | filter noff nodecay noabnormal | count",
+        f"index all | filter season({l[-1].season}) seed_type(village) | count",
+        "index all | filter completed bastion(bridge) | sort duration | take 10",
+    ]
+    rows = []
+    for name in ("row by row", "bitmaps"):
+        datasets = {n: Dataset(n, idx, root=True) for n, idx in build_indexes(ROOT_INDEXES, l, l[-1].season).items()}
+        if name == "bitmaps":
+            for d in datasets.values():
+                d.keep_bitmaps()
+        datasets["__uuids"], datasets["__users"] = Dataset("UUIDs", uuids), Dataset("Users", users)
+
+        def run(q):
+            rt = runtime.Runtime(datasets=datasets, commands=dict())
+            rt.execute(*Compiler().compile(Tokenizer().tokenize(q), source=q))
+            return rt._result
+
+        for q in queries:
+            # The first run builds the bitmaps.
+            _, first = timed(run, q)
+            t = min([timed(run, q)[1] for _ in range(5)])
+            rows.append((f"{name}: {q}", f"first {first * 1000:.1f}ms", f"then {t * 1000:.1f}ms (best of 5)"))
+    report(f"bitmaps: {len(l)} matches", rows)
+
+
+@Bench
+def season_indexes(scale=20):
+    from . import runtime
+    from .dataset import ROOT_INDEXES, GetUserMappings, build_indexes, load_raw_matches
+    from .language import Compiler, Tokenizer
+
+    with tempfile.TemporaryDirectory() as tmp:
+        l = load_raw_matches(scaled_samples(f"{tmp}/", scale), True)
+    uuids, users = GetUserMappings(l)
+    # Like the bot's quicklook: one player's matches this season.
+    queries = [f"index s{l[-1].season} | count", f"index s{l[-1].season} | filter uuid(lowk3y_) noff | count"]
+    rows = []
+    for name in ("filter most", "season indexes"):
+        datasets = {n: Dataset(n, idx, root=True).index_players().keep_orders().keep_bitmaps() for n, idx in build_indexes(ROOT_INDEXES, l, l[-1].season).items()}
+        datasets["__uuids"], datasets["__users"] = Dataset("UUIDs", uuids), Dataset("Users", users)
+        if name == "filter most":
+            datasets["most"].season_index = lambda season: None
+
+        def run(q):
+            rt = runtime.Runtime(datasets=datasets, commands=dict())
+            rt.execute(*Compiler().compile(Tokenizer().tokenize(q), source=q))
+            return rt._result
+
+        for q in queries:
+            # The first run splits most into seasons.
+            _, first = timed(run, q)
+            t = min([timed(run, q)[1] for _ in range(5)])
+            rows.append((f"{name}: {q}", f"first {first * 1000:.1f}ms", f"then {t * 1000:.1f}ms (best of 5)"))
+    report(f"season_indexes: {len(l)} matches", rows)
+
+
+@Bench
+def shared_prefixes(scale=20):
+    # Like the bot's quicksplits: the same `index | filter | to_timelines` for every split.
+    from . import runtime
+    from .dataset import ROOT_INDEXES, GetUserMappings, build_indexes, load_raw_matches
+    from .language import Compiler, Tokenizer
+
+    with tempfile.TemporaryDirectory() as tmp:
+        l = load_raw_matches(scaled_samples(f"{tmp}/", scale), True)
+    uuids, users = GetUserMappings(l)
+    datasets = {n: Dataset(n, idx, root=True) for n, idx in build_indexes(ROOT_INDEXES, l, l[-1].season).items()}
+    datasets["__uuids"], datasets["__users"] = Dataset("UUIDs", uuids), Dataset("Users", users)
+    tls = f"| index s{l[-1].season} | filter uuid(lowk3y_) | to_timelines"
+    splits = ["nether.root", "nether.find_bastion", "nether.find_fortress", "story.follow_ender_eye", "story.enter_the_end", "end.root"]
+    q = "".join([f"{tls} | splits.get_if {s} | filter uuid(lowk3y_) | count | average time " for s in splits])
+
+    def run():
+        rt = runtime.Runtime(datasets=datasets, commands=dict())
+        rt.execute(*Compiler().compile(Tokenizer().tokenize(q), source=q))
+        return rt._result
+
+    rows = []
+    results = []
+    shared = runtime.shared_prefixes
+    for name, f in (("every part from scratch", lambda keys: set()), ("shared prefixes", shared)):
+        runtime.shared_prefixes = f
+        try:
+            res, t = timed(run)
+        finally:
+            runtime.shared_prefixes = shared
+        results.append(res)
+        rows.append((name, f"{t * 1000:.1f}ms"))
+    assert results[0] == results[1]
+    report(f"shared_prefixes: {len(splits)} splits over {len(l)} matches", rows)
+
+
+@Bench
+def ingest(scale=4, rate=2000):
+    """
+    Replays the last quarter of the (scaled) group files as live messages,
+    rate per second (0: all at once), through a LocalTransport.
+    """
+    import contextlib
+    import io
+    import threading
+    from . import dataset
+    from .transport import LocalTransport
+
+    with tempfile.TemporaryDirectory() as tmp:
+        d = scaled_samples(f"{tmp}/", scale)
+        groups = dataset.default_groups(d)
+        messages = list()
+        for g in groups[len(groups) * 3 // 4 :]:
+            with open(f"{d}{g}") as file:
+                for l in file:
+                    if l.strip() != "{}":
+                        mid = json.loads(l)["match_id"]
+                        messages.append((mid, f"{mid}|{l.strip()}".encode()))
+            os.remove(f"{d}{g}")
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            dataset.load_defaults(d, quiet=True, no_mq=True)
+            first = dataset.current_version()
+            transport = LocalTransport()
+            conn = dataset.PikaConnection(transport)
+            conn.start_consuming()
+
+            sent = [0.0] * len(messages)
+
+            def sender():
+                start = time.time()
+                for i, (_, body) in enumerate(messages):
+                    if rate:
+                        time.sleep(max(0.0, start + i / rate - time.time()))
+                    sent[i] = time.time()
+                    transport.send(body)
+
+            thread = threading.Thread(target=sender)
+            start = time.time()
+            thread.start()
+            lags = list()
+            while len(lags) < len(messages) and time.time() - start < 600:
+                last = dataset.current_version().datasets["all"].l[-1].id
+                now = time.time()
+                while len(lags) < len(messages) and messages[len(lags)][0] <= last:
+                    lags.append(now - sent[len(lags)])
+                time.sleep(0.001)
+            total = time.time() - start
+            thread.join()
+            conn.stop()
+
+        lags.sort()
+        report(
+            f"ingest: {len(messages)} live matches onto {len(first.datasets['all'].l)}, rate {rate or 'unlimited'}/s",
+            [
+                ("ingested", f"{len(lags) / total:.0f} matches/s"),
+                ("versions published", dataset.current_version().number - first.number),
+                ("freshness lag p50", f"{lags[len(lags) // 2] * 1000:.1f}ms"),
+                ("freshness lag p95", f"{lags[len(lags) * 95 // 100] * 1000:.1f}ms"),
+                ("freshness lag max", f"{lags[-1] * 1000:.1f}ms"),
+            ],
+        )
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    kwargs = dict()
+    for flag in ("--scale", "--rate"):
+        if flag in args:
+            i = args.index(flag)
+            kwargs[flag[2:]] = int(args[i + 1])
+            del args[i : i + 2]
+    for name in args or bench_registry.keys():
+        if name not in bench_registry:
+            raise RuntimeError(f"{name} is not a benchmark. Valid benchmarks: {list(bench_registry.keys())}")
+        # --rate is only for ingest, so only pass what each one takes.
+        params = inspect.signature(bench_registry[name]).parameters
+        bench_registry[name](**{k: v for k, v in kwargs.items() if k in params})
@@ -0,0 +1,120 @@
+"""
+For a root index, which positions have each value of the attributes that get
+filtered on all the time (noff, nodecay, season(9), seed_type(village)...),
+as the bits of an int. A filter on those is then a few &s instead of looking
+at every match. Each attribute is worked out the first time it's filtered on,
+and a newer version of the index adds its live matches on the first time
+it's filtered on (see Dataset.updated).
+"""
+from itertools import compress
+from typing import Any, Callable
+
+from .match import QueryMatch
+from .prefix import Prefix
+
+BITMAP_ATTRIBUTES = {
+    "is_ff",
+    "is_decay",
+    "is_abnormal",
+    "is_completed",
+    "is_playoffs",
+    "was_fixed",
+    "has_elos",
+    "scored",
+    "spectated",
+    "type",
+    "season",
+    "seed_type",
+    "bastion",
+    "category",
+    "tag",
+}
+
+# Only values like these are kept, so a dict lookup is the same as ==.
+SIMPLE_TYPES = (bool, int, str, type(None))
+
+# 0/1 bytes <-> '0'/'1' digits.
+TO_DIGITS = bytes.maketrans(b"\x00\x01", b"01")
+FROM_DIGITS = bytes.maketrans(b"01", b"\x00\x01")
+
+
+def to_bits(mask: bytearray) -> int:
+    # Bit i is mask[i].
+    return int(mask.translate(TO_DIGITS)[::-1], 2) if mask else 0
+
+
+def to_mask(bits: int) -> bytes:
+    # mask[i] is bit i (and it stops at the last set bit).
+    return bin(bits)[:1:-1].encode().translate(FROM_DIGITS)
+
+
+def by_value(l: list[QueryMatch], get: Callable) -> dict[Any, int] | None:
+    # value -> bits of the positions in l with that value. None if they're not all simple.
+    masks: dict[Any, bytearray] = dict()
+    try:
+        for i, m in enumerate(l):
+            v = get(m)
+            mask = masks.get(v)
+            if mask is None:
+                if not isinstance(v, SIMPLE_TYPES):
+                    return None
+                mask = masks[v] = bytearray(len(l))
+            mask[i] = 1
+    except Exception:
+        # Whoever filters on it row by row gets to see this.
+        return None
+    return {v: to_bits(mask) for v, mask in masks.items()}
+
+
+class Bitmaps:
+    def __init__(self, l: list[QueryMatch] | Prefix, behind: dict | None = None):
+        self.source = l if isinstance(l, Prefix) else Prefix.of(l)
+        # attribute -> (getter, by_value), or None if it can't be kept.
+        self.kept: dict[str, tuple[Callable, dict[Any, int]] | None] = dict()
+        # attribute -> (getter, by_value of an older version, how many positions that has).
+        # A new version catches up from there the first time it's filtered on (see updated).
+        self.behind: dict[str, tuple[Callable, dict[Any, int], int] | None] = behind or dict()
+
+    @property
+    def l(self) -> list[QueryMatch]:
+        return self.source.l
+
+    def updated(self, source: list[QueryMatch] | Prefix, start: int) -> "Bitmaps":
+        behind = dict(self.behind)
+        # Queries can be building bitmaps on this version meanwhile.
+        for attribute, kept in list(self.kept.items()):
+            behind[attribute] = None if kept is None else (kept[0], kept[1], start)
+        return Bitmaps(source, behind)
+
+    def catch_up(self, attribute: str, get: Callable) -> tuple[Callable, dict[Any, int]] | None:
+        if attribute not in self.behind:
+            values = by_value(self.l, get)
+            return None if values is None else (get, values)
+        old = self.behind[attribute]
+        if old is None:
+            return None
+        get, values, n = old
+        added = by_value(self.l[n:], get)
+        if added is None:
+            return None
+        values = dict(values)
+        for v, bits in added.items():
+            values[v] = values.get(v, 0) | (bits << n)
+        return get, values
+
+    def bits(self, attribute: str, value, get: Callable) -> int | None:
+        # The positions where get(m) == value. None if attribute isn't kept.
+        if attribute not in BITMAP_ATTRIBUTES:
+            return None
+        kept = self.kept.get(attribute, False)
+        if kept is False:
+            kept = self.kept[attribute] = self.catch_up(attribute, get)
+        if kept is None:
+            return None
+        try:
+            return kept[1].get(value, 0)
+        except TypeError:
+            return None
+
+    def matches(self, bits: int) -> list[QueryMatch]:
+        return list(compress(self.l, to_mask(bits)))
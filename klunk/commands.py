@@ -1,5 +1,6 @@
-from typing import Callable
-from .dataset import Dataset
+from itertools import islice
+from typing import Callable, Iterator
+from .dataset import Dataset, Stream
 
 
 class ExecutableExpression:
@@ -11,18 +12,34 @@ class ExecutableExpression:
     def __call__(self, d: Dataset):
         return self.executor(d, *self.args, **self.kwargs)
 
+    def stream(self, s: Stream) -> Iterator | None:
+        if self.executor.stream is None:
+            return None
+        return self.executor.stream(s, *self.args, **self.kwargs)
+
 
 class Executor:
     def __init__(self, func, greedy=True, print_dataset=True):
         self.func = func
         self.greedy = greedy
         self.print_dataset = print_dataset
+        self.stream = None
 
         self.help = func.__doc__
 
     def __call__(self, *args, **kwargs):
         return self.func(*args, **kwargs)
 
+    def streamer(self, f: Callable):
+        """
+        Registers f(s: Stream, *args) as the streaming version of this command: it returns
+        an iterator over what the command would have returned for list(s), without
+        needing all of s first. Or None, if it can't do that with these arguments.
+        The runtime chains streaming commands and only makes a list when it has to.
+        """
+        self.stream = f
+        return f
+
     def prime(self, *args, **kwargs):
         return ExecutableExpression(self, *args, **kwargs)
 
@@ -48,12 +65,16 @@ TESTING_ONLY = False
 basic_commands = dict()
 logger = None
 
+# Commands that can give a different result on the same data, so queries using
+# them can't come out of the result cache (see sandbox.ResultCache).
+UNCACHEABLE = {"randomselect"}
+
 
 def Command(f: Callable):
     global basic_commands
     realname = f.__name__[len("_command_") :]
     basic_commands[realname] = Executor(f) # add other stuff later lol
-    return Executor(f)
+    return basic_commands[realname]
 
 
 def TestCommand(f: Callable):
@@ -109,6 +130,13 @@ def _command_dropn(d: Dataset, val: str):
     return d.l[int(val) :]
 
 
+@_command_dropn.streamer
+def _stream_dropn(s: Stream, val: str):
+    if not val.isdigit():
+        return None
+    return islice(s.rest(), int(val), None)
+
+
 @Command
 def _command_flatten(d: Dataset):
     """
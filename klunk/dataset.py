@@ -2,9 +2,22 @@ from klunk.extra_types import UUID, Milliseconds, Seconds
 from klunk.utils import time_fmt
 from .match import MatchMember, QueryMatch, Timeline, TimelineList, from_json_string
 from .filters import *
-from typing import Any
+from typing import Any, Callable, Iterator
+from array import array
+from collections import ChainMap
+from itertools import chain
 from .players import Player
-from klunk.dyn import dynamic_query, finish_query
+from klunk.dyn import dynamic_query, finish_query, todos as pending_queries
+from . import snapshot
+from .journal import Journal
+from .partitions import PartitionCache, PartitionWriter, add_to_partitions
+from .transport import PikaTransport, Transport
+from .bitmaps import Bitmaps
+from .orders import SortOrders
+from .postings import Postings
+from .prefix import Prefix
+import threading
+import time
 
 # From Sichi! :) Thanks
 PLAYOFFS_SEASON_1 = [371960, 372000, 372046, 372084, 372180, 372221, 372262, 372339, 372371, 372402, 372462, 372497, 372529, 372595, 372634, 372672, 372737, 372796, 372840, 372912, 372961, 388232, 388265, 388302, 388361, 388401, 388443, 388480, 388513, 388574, 388590, 388616, 388639, 388701, 388725, 388749, 388774, 388801, 390660, 390690, 390710, 390804, 390829, 390863, 390887, 390923, 391015, 391060, 391103, 391138, 391210, 391246, 391274, 391317, 391348, 391376, 391403]
@@ -15,10 +28,10 @@ PLAYOFFS_SEASON_3 = [709562, 709596, 709684, 709733, 709803, 709865, 709936, 709
 
 PLAYOFFS = PLAYOFFS_SEASON_1 + PLAYOFFS_SEASON_2 + PLAYOFFS_SEASON_3
 
-_datasets_ = None
+_version_: "DatasetVersion | None" = None
 __discord = False
 
-SUPPORTED_ITERABLES = set([list, dict, set, tuple, TimelineList])
+SUPPORTED_ITERABLES = set([list, dict, ChainMap, set, tuple, TimelineList])
 CURRENT_SEASON = None
 
 def first_not_none(l):
@@ -27,109 +40,250 @@ def first_not_none(l):
             return x
     return None
 
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+
+
 class PikaConnection:
-    def __init__(self):
-        self.connection = None
-        self.channel = None
-        self.recv: list[bytes] = list()
-        self.broken = False
+    """
+    Consumes rql-ipc (or whatever transport it's given) on its own thread, so that queries don't have to.
+    Messages are parsed, journaled and turned into the next DatasetVersion
+    on that thread too, which is then published in one go.
+    """
 
-    def callback(self, ch, method, __1__, body):
-        print(f"received body with len {len(body)} (first bit: {body[0:24]})")
-        self.recv.append(body)
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+    def __init__(self, transport: Transport):
+        self.transport = transport
+        self.recv: list[bytes] = list()
+        self.thread: threading.Thread | None = None
+        self.stopped = False
+        # Set if an update could not be applied, reported by the next query.
+        self.error: str | None = None
 
     def start_consuming(self):
+        if self.thread is None:
+            self.stopped = False
+            self.thread = threading.Thread(target=self.run, name="rql-ipc consumer", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        delay = RECONNECT_MIN_DELAY
+        first = True
+        while not self.stopped:
+            try:
+                self.transport.connect()
+                if first:
+                    # clear out the queue. (Only at startup: after a reconnect, it's all new.)
+                    self.transport.drain()
+                    first = False
+                delay = RECONNECT_MIN_DELAY
+                while not self.stopped:
+                    self.recv.extend(self.transport.poll(1))
+                    self.update_datasets()
+            except ImportError as e:
+                print(f"Not consuming rql-ipc: {e}")
+                return
+            except Exception as e:
+                print(f"RabbitMQ consumer lost its connection ({type(e)}: {e}), reconnecting in {delay}s.")
+                time.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+        self.transport.close()
+
+    def update_datasets(self):
+        # Wait for load_defaults to finish before we touch anything.
+        if not self.recv or _version_ is None:
+            return
+        recv = self.recv
+        self.recv = list()
+        print(f"Updating with {len(recv)} matches.")
         try:
-            import pika
+            res, accepted = parse_messages(recv)
+            if not res:
+                return
+            # On disk before we use it, so that a restart doesn't lose it.
+            if JOURNAL is not None:
+                JOURNAL.append(accepted)
+
+            version = _version_
+            season = max([m.season for m in res] + [version.season])
+            datasets = version.datasets
+            if season != version.season:
+                # New season: its default index goes out with the update.
+                print(f"Season {season} has started, rolling over from season {version.season}.")
+                datasets = dict(datasets, default=rollover_default(datasets, season))
+            updated = apply_update(datasets, res, season)
+            if updated is datasets:
+                return
+            publish(DatasetVersion(version.number + 1, updated, season))
+            compact_journal()
+        except Exception as e:
+            # Not a connection problem, so don't reconnect over it.
+            print(f"Could not apply live update: {type(e)}: {e}")
+            self.error = str(e)
 
-            self.connection = pika.BlockingConnection(pika.ConnectionParameters(host="localhost"))
-            self.channel = self.connection.channel()
-            self.channel.queue_declare(queue="rql-ipc")
-            self.channel.basic_consume(on_message_callback=lambda *args: self.callback(*args), queue="rql-ipc")
 
-            # clear out the queue.
-            self.connection.process_data_events(0)
-            self.recv.clear()
-        except Exception as e:
-            print(e)
-            self.broken = True
+class DatasetVersion:
+    """
+    The root datasets as of some update. A version is never changed once
+    published: live matches make a new version (see apply_update), which
+    shares every match, and every dataset that didn't change, with this one.
+    A query holds on to the version it started with, so it never sees an
+    update land half way through. Versions nobody holds are simply collected.
+    number goes up by one per version, for anything that caches by version.
+    """
 
-    def attempt_process_pika(self, itr=0):
-        if self.broken:
-            print("ignored attempt to process pika, broken")
-            return
-        try:
-            assert self.connection is not None
-            self.connection.process_data_events(0)
-            self.connection.sleep(0.1)
-        except:
-            if itr > 4:
-                self.broken = True
-                raise RuntimeError("Auto updating has broken :sob: please retry your query.")
-            import pika
-
-            self.connection = pika.BlockingConnection(pika.ConnectionParameters(host="localhost"))
-            self.channel = self.connection.channel()
-            self.channel.queue_declare(queue="rql-ipc")
-            self.channel.basic_consume(on_message_callback=lambda *args: self.callback(*args), queue="rql-ipc")
-            self.attempt_process_pika(itr + 1)
+    __slots__ = ("number", "datasets", "season")
 
-    def update_datasets(self):
-        global _datasets_
-        if self.connection is None:
-            print('did not update datasets: no connection')
-            return
-        self.attempt_process_pika()
+    def __init__(self, number: int, datasets: dict[str, "Dataset"], season: int):
+        self.number = number
+        self.datasets = datasets
+        self.season = season
 
-        recv = self.recv
-        self.recv = list()
-        ilen = len(recv)
-        if not recv:
-            return
-        print(f"Updating with {ilen} matches.")
-        # Check for validity first.
-        recv = [m.decode() for m in recv]
-        recv = [m for m in [m.split("|", maxsplit=1) for m in recv] if len(m) == 2 and m[0].isnumeric()]
-        alen = len(recv)
-        if alen != ilen:
-            print(f"Removed {ilen - alen} bad messages (test/etc?)")
-
-        if not recv:
-            return
 
-        # Actually update with these matches.
-        res: list[QueryMatch] = list()
-        for n, l in recv:
-            stripped = l.strip()
-            if stripped != "{}":
-                try:
-                    res.append(from_json_string(stripped))
-                except Exception as e:
-                    print(f"Char 0: {stripped[0]}")
-                    raise RuntimeError(f'Bad JSON document: "{stripped}"') from e
-            else:
-                pass
+def current_version() -> DatasetVersion | None:
+    return _version_
+
+
+def publish(version: DatasetVersion):
+    global _version_, CURRENT_SEASON
+    _version_ = version
+    CURRENT_SEASON = version.season
 
-        if not res:
-            return
 
-        assert _datasets_ is not None
-        if res[0].season != res[-1].season or res[0].season != _datasets_["default"].l[0].season:
-            raise RuntimeError(f"The current season has changed. Please tell DesktopFolder to reboot the bot :)")
+# Root datasets that aren't indexes of matches, but are derived from them:
+# name -> f(dataset, new matches) -> the dataset with those matches taken into account.
+# apply_update runs every one of these on every batch. Register with @Derived(name).
+DERIVED: dict[str, Callable[["Dataset", list[QueryMatch]], "Dataset"]] = dict()
 
-        # assume default is unchanged.
-        res = sorted(res, key=lambda m: m.id)
-        _datasets_["default"].update(AsDefaultDatalist(res, res[0].season))
-        _datasets_["all"].update(res)
-        _datasets_["most"].update(AsMostDatalist(res))
-        _datasets_["matchanalysis"].update(to_idx("ranked.nodecay.noabnormal", res))
-        uuids, users = GetUserMappings(res)
-        _datasets_["__uuids"].update_overwrite_dict(uuids)
-        _datasets_["__users"].update_overwrite_dict(users)
 
+def Derived(name: str):
+    def register(f):
+        DERIVED[name] = f
+        return f
 
-_mq_ = PikaConnection()
+    return register
+
+
+@Derived("__uuids")
+def derive_uuids(d: "Dataset", res: list[QueryMatch]):
+    return d.updated_dict({p.uuid: p.user for m in res for p in m.members})
+
+
+@Derived("__users")
+def derive_users(d: "Dataset", res: list[QueryMatch]):
+    return d.updated_dict({p.user.lower(): p.uuid for m in res for p in m.members})
+
+
+# updated_dict merges what it added into the rest once that's this many times smaller.
+DICT_OVERLAY_RATIO = 16
+
+
+def apply_update(datasets: dict, res: list[QueryMatch], season: int) -> dict:
+    """
+    Returns the root datasets with new live matches added. season is the current season.
+    datasets itself is left alone, and returned as it is if none of res are new.
+    Each match is looked at once for all the indexes (see build_indexes), plus once per DERIVED entry.
+    """
+    # ensure we don't get duplicate matches
+    all_l = datasets["all"].l
+    last_mid = all_l[-1].id if all_l else -1
+    new: list[QueryMatch] = list()
+    for m in sorted(res, key=lambda m: m.id):
+        if m.id > last_mid:
+            new.append(m)
+            last_mid = m.id
+    if len(new) != len(res):
+        print(f"removed {len(res) - len(new)} matches from update (dupes)")
+    if not new:
+        # Nothing changed, so no new version either (which would empty the result cache).
+        return datasets
+
+    live = {name: d for name, d in ROOT_INDEXES.items() if type(d[1]) == str}
+    unranked = not all([m.is_ranked() for m in new])
+    datasets = dict(datasets)
+    for name, idx in build_indexes(live, new, season).items():
+        if idx:
+            datasets[name] = datasets[name].updated(idx, unranked and "ranked" not in to_idx_key(live[name][1]))
+    for name, f in DERIVED.items():
+        datasets[name] = f(datasets[name], new)
+    return datasets
+
+
+def by_season(l: list[QueryMatch]) -> dict[int, list[QueryMatch]]:
+    res: dict[int, list[QueryMatch]] = dict()
+    for m in l:
+        idx = res.get(m.season)
+        if idx is None:
+            idx = res[m.season] = list()
+        idx.append(m)
+    return res
+
+
+def rollover_default(datasets: dict, season: int) -> "Dataset":
+    """
+    A new default dataset for season, from whatever of it is already loaded
+    (usually nothing, the live matches that start it are added afterwards).
+    """
+    l = datasets["all"].l
+    start = len(l)
+    while start > 0 and l[start - 1].season >= season:
+        start -= 1
+    title, d = ROOT_INDEXES["default"]
+    return Dataset(title, build_indexes({"default": (title, d)}, l[start:], season)["default"], root=True).index_players().keep_orders().keep_bitmaps()
+
+
+def parse_messages(recv: list[bytes]) -> tuple[list[QueryMatch], list[bytes]]:
+    """
+    Parses queue messages ("match_id|json"). Returns the matches, and the messages they came from.
+    """
+    ilen = len(recv)
+    # Check for validity first.
+    checked = [(body, body.decode().split("|", maxsplit=1)) for body in recv]
+    checked = [(body, m) for body, m in checked if len(m) == 2 and m[0].isnumeric()]
+    if len(checked) != ilen:
+        print(f"Removed {ilen - len(checked)} bad messages (test/etc?)")
+
+    res: list[QueryMatch] = list()
+    accepted: list[bytes] = list()
+    for body, (n, l) in checked:
+        stripped = l.strip()
+        if stripped != "{}":
+            try:
+                res.append(from_json_string(stripped))
+            except Exception as e:
+                print(f"Char 0: {stripped[0]}")
+                raise RuntimeError(f'Bad JSON document: "{stripped}"') from e
+            accepted.append(body)
+    return res, accepted
+
+
+def compact_journal(force=False):
+    """
+    Folds the journal into the snapshot once it is big enough (or if force is set).
+    """
+    version = _version_
+    if JOURNAL is None or version is None or SNAPSHOT_STATE is None:
+        return
+    if not force and JOURNAL.size() < JOURNAL_COMPACT_BYTES:
+        return
+    dirname, mtimes = SNAPSHOT_STATE
+    try:
+        datasets = version.datasets
+        # Merged for good, as it costs about the same as writing them anyways.
+        write_snapshot(dirname, datasets["all"].l, mtimes, datasets["__uuids"].merged_dict(), datasets["__users"].merged_dict())
+    except OSError as e:
+        print(f"Could not compact journal into the snapshot: {e}")
+        return
+    # Only now: if we crash before this, replaying the journal again is harmless.
+    JOURNAL.clear()
+
+
+_mq_ = PikaConnection(PikaTransport())
 
 
 def default_groups(dirname):
@@ -140,33 +294,124 @@ def default_groups(dirname):
     ]
 
 
+# Seasons kept out of memory, with the match ids that are kept anyways.
+# The rest of these seasons is only loaded on demand, see partitions.py.
+IGNORED_SEASONS = {0: [], 1: PLAYOFFS_SEASON_1, 2: PLAYOFFS_SEASON_2, 3: PLAYOFFS_SEASON_3, 4: [], 5: [], 6: [], 7: []}
+
+# Number of processes load_raw_matches uses. Set from bot.py (--load-workers N).
+LOAD_WORKERS = 1
+
+# Most matches from on-demand season partitions to keep in memory. Set from bot.py (--partition-budget N).
+PARTITION_BUDGET = 1000000
+PARTITIONS: PartitionCache | None = None
+
+# Where the snapshot, journal and season partitions go. None is next to the group files.
+# Set from bot.py (--cache-dir DIR), tests use a temporary one.
+CACHE_DIR: str | None = None
+
+# Journal of live matches, and how big it gets before it is folded into the snapshot.
+JOURNAL_NAME = "rql.journal"
+JOURNAL_COMPACT_BYTES = 64 * 1024 * 1024
+JOURNAL: Journal | None = None
+# (cache dir, group file mtimes) that the in-memory matches were loaded with.
+SNAPSHOT_STATE: tuple[str, dict[str, float]] | None = None
+
+
+def never_skip(_):
+    return False
+
+
+def skip_ignored_seasons(data):
+    passthrough = IGNORED_SEASONS.get(data.season)
+    if passthrough is None:
+        return False
+    return data.id not in passthrough
+
+
 def get_skip_rule(groups):
+    # Module level functions (not lambdas) so that they can be sent to loader processes.
     if len(groups) < 20:
-        return lambda _: False
-    def skip_rule(data):
-        ignore_seasons = [(0, []), (1, PLAYOFFS_SEASON_1), (2, PLAYOFFS_SEASON_2), (3, PLAYOFFS_SEASON_3), (4, []), (5, []), (6, []), (7, [])]
-        for s, passthrough in ignore_seasons:
-            if data.season == s:
-                if data.id in passthrough:
-                    return False
-                return True
-        return False
-    return skip_rule
+        return never_skip
+    return skip_ignored_seasons
 
 
-def load_raw_matches(dirname, quiet=False) -> list[QueryMatch]:
+def load_group(path, skip_rule, on_load=None, on_skip=None):
+    """
+    Parses one group file. Returns (matches kept by skip_rule, number of {} lines).
+    on_load is called with every parsed match, skipped or not. on_skip only with skipped ones.
+    """
+    res: list[QueryMatch] = list()
+    ignored = 0
+    with open(path) as file:
+        # one line = one match
+        for l in file:
+            stripped = l.strip()
+            if stripped != "{}":
+                try:
+                    data = from_json_string(stripped)
+                except Exception as e:
+                    print(f"Char 0: {stripped[0]}")
+                    raise RuntimeError(f'Bad JSON document: "{stripped}"') from e
+                if on_load is not None:
+                    on_load(data)
+                if skip_rule(data):
+                    if on_skip is not None:
+                        on_skip(data)
+                    continue
+                res.append(data)
+            else:
+                ignored += 1
+    return res, ignored
+
+
+def load_group_rows(path, skip_rule, keep_skipped=False):
+    # Runs in a loader process. Rows pickle far faster than QueryMatch objects do.
+    skipped = list()
+    res, ignored = load_group(path, skip_rule, on_skip=skipped.append if keep_skipped else None)
+    return [m.to_row() for m in res], [m.to_row() for m in skipped], ignored
+
+
+def load_groups_parallel(paths, skip_rule, workers, on_skip=None):
+    from concurrent.futures import ProcessPoolExecutor
+    from itertools import repeat
+
+    res: list[QueryMatch] = list()
+    ignored = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # map() yields in submission order, i.e. default_groups order, so this stays sorted.
+        for rows, skipped, group_ignored in pool.map(load_group_rows, paths, repeat(skip_rule), repeat(on_skip is not None)):
+            res.extend([QueryMatch.from_row(row) for row in rows])
+            for row in skipped:
+                on_skip(QueryMatch.from_row(row))
+            ignored += group_ignored
+    return res, ignored
+
+
+def load_raw_matches(dirname, quiet=False, groups=None, workers=1, on_skip=None) -> list[QueryMatch]:
     """
     This function does all of the match loading for the bot. Loads from
     our kind-of-cursed database system/datastore.
     Now only loads [s4, s5...]
     i.e. we are now ignoring s3 or previous matches, EXCEPT playoffs games.
+    If groups is given, only those group files are read.
+    With workers > 1, group files are parsed by a pool of that many processes.
+    on_skip is called (in match id order) with every match that is not loaded.
     """
     import time
     assert not dirname or dirname.endswith("/")
 
     # [100000-120000.txt, ...]
-    groups = default_groups(dirname)
-    skip_rule = get_skip_rule(groups)
+    all_groups = default_groups(dirname)
+    skip_rule = get_skip_rule(all_groups)
+    groups = all_groups if groups is None else groups
+    paths = [f"{dirname}{g}" for g in groups]
+
+    if workers > 1 and pending_queries:
+        print("Dynamic queries are pending (see dyn.py), loading on one process.")
+        workers = 1
+
+    print("----- Starting load_raw_matches -----")
+    now = time.time()
 
     # list[QueryMatch]
     res: list[QueryMatch] = list()
@@ -174,26 +419,13 @@ def load_raw_matches(dirname, quiet=False) -> list[QueryMatch]:
     # Debug - number of matches we ignore (= {})
     ignored = 0
 
-    print("----- Starting load_raw_matches -----")
-    now = time.time()
-
-    for g in groups:
-        with open(f"{dirname}{g}") as file:
-            # one line = one match
-            for l in file:
-                stripped = l.strip()
-                if stripped != "{}":
-                    try:
-                        data = from_json_string(stripped)
-                        dynamic_query(data)
-                        if skip_rule(data):
-                            continue
-                        res.append(data)
-                    except Exception as e:
-                        print(f"Char 0: {stripped[0]}")
-                        raise RuntimeError(f'Bad JSON document: "{stripped}"') from e
-                else:
-                    ignored += 1
+    if workers > 1 and len(paths) > 1:
+        res, ignored = load_groups_parallel(paths, skip_rule, workers, on_skip=on_skip)
+    else:
+        for path in paths:
+            group, group_ignored = load_group(path, skip_rule, on_load=dynamic_query, on_skip=on_skip)
+            res.extend(group)
+            ignored += group_ignored
     finish_query()
     print("----- Finished load_raw_matches -----")
     print("Loading matches took", time.time() - now, "seconds.")
@@ -201,11 +433,130 @@ def load_raw_matches(dirname, quiet=False) -> list[QueryMatch]:
         print(f"Loaded {len(res)} matches. Ignored {ignored} bad matches.")
     if not all(res[i]["match_id"] < res[i + 1]["match_id"] for i in range(0, len(res) - 1)):
         raise RuntimeError("Matches are out of order!")
-    if not quiet:
+    if not quiet and res:
         print(f'Latest match id: {res[-1]["match_id"]}')
     return res
 
 
+SNAPSHOT_NAME = "rql.snapshot"
+
+
+def group_mtimes(dirname, groups):
+    from os.path import getmtime
+
+    return {g: getmtime(f"{dirname}{g}") for g in groups}
+
+
+def load_matches(dirname, quiet=False, workers=1, cache_dir=None):
+    """
+    Returns (matches, uuids, users), as load_raw_matches + cleanup_matches + GetUserMappings would.
+    Reads the binary snapshot in cache_dir (dirname if not given) if there is one, and only parses
+    group files that have changed since it was written. Rewrites the snapshot if anything was parsed.
+    Matches that load_raw_matches skips go to season partitions (see partitions.py).
+    Finally, live matches from the journal are added, and folded into the snapshot.
+    While dyn.py has queries that haven't finished yet, everything is parsed again instead.
+    """
+    import time
+    global SNAPSHOT_STATE
+
+    if cache_dir is None:
+        cache_dir = dirname
+    path = f"{cache_dir}{SNAPSHOT_NAME}"
+    mtimes = group_mtimes(dirname, default_groups(dirname))
+
+    now = time.time()
+    snap = None
+    if pending_queries:
+        # They see every parsed match, skipped ones too - the snapshot doesn't have those.
+        print("Dynamic queries are pending (see dyn.py), not using the snapshot.")
+    else:
+        snap = snapshot.read(path)
+    stale = list()
+    if snap is None:
+        writer = PartitionWriter(cache_dir)
+        # Players that only show up in partitions still need names.
+        old_uuids, old_users = dict(), dict()
+
+        def on_skip(m: QueryMatch):
+            writer.add(m)
+            AddUserMappings(m, old_uuids, old_users)
+
+        try:
+            l = cleanup_matches(load_raw_matches(dirname, quiet, workers=workers, on_skip=on_skip))
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+        uuids, users = GetUserMappings(l)
+        uuids, users = old_uuids | uuids, old_users | users
+    else:
+        header, l = snap
+        uuids, users = header["uuids"], header["users"]
+        print(f"Loaded {len(l)} matches from snapshot in {time.time() - now} seconds.")
+        stale = [g for g, t in mtimes.items() if header["groups"].get(g) != t]
+        if stale:
+            print(f"Group files changed since the snapshot was written: {stale}")
+            l, uuids, users = load_stale_groups(dirname, cache_dir, stale, l, uuids, users, quiet, workers)
+
+    journal = Journal(f"{cache_dir}{JOURNAL_NAME}")
+    tail = replay_journal(journal, l, uuids, users)
+
+    SNAPSHOT_STATE = (cache_dir, mtimes)
+    if snap is None or stale or tail:
+        try:
+            write_snapshot(cache_dir, l, mtimes, uuids, users)
+        except OSError as e:
+            print(f"Could not write snapshot to {path}: {e}")
+        else:
+            journal.clear()
+    return l, uuids, users
+
+
+def load_stale_groups(dirname, cache_dir, stale, l, uuids, users, quiet, workers):
+    """
+    Adds the matches from group files that changed after the snapshot was written.
+    """
+    known = set(m.id for m in l)
+    skipped: list[QueryMatch] = list()
+    new = [m for m in load_raw_matches(dirname, quiet, groups=stale, workers=workers, on_skip=skipped.append) if m.id not in known]
+    if skipped:
+        add_to_partitions(cache_dir, skipped)
+        old_uuids, old_users = GetUserMappings(skipped)
+        uuids, users = old_uuids | uuids, old_users | users
+    if new and l and min(m.id for m in new) < l[-1].id:
+        # Rare - only if an old group was rewritten. Just redo everything that depends on order.
+        l = sorted(l + new, key=lambda m: m.id)
+        new_uuids, new_users = GetUserMappings(l)
+        uuids, users = uuids | new_uuids, users | new_users
+    else:
+        l.extend(new)
+        new_uuids, new_users = GetUserMappings(new)
+        uuids.update(new_uuids)
+        users.update(new_users)
+    # Tag propagation only ever fills in missing tags, so rerunning it is fine.
+    cleanup_matches(l)
+    return l, uuids, users
+
+
+def replay_journal(journal: Journal, l: list[QueryMatch], uuids, users) -> list[QueryMatch]:
+    """
+    Adds the journal's matches that are newer than l to it. Returns them.
+    """
+    res, _ = parse_messages(journal.records())
+    last = l[-1].id if l else -1
+    tail = sorted({m.id: m for m in res if m.id > last}.values(), key=lambda m: m.id)
+    if tail:
+        print(f"Replayed {len(tail)} matches from the journal.")
+    for m in tail:
+        AddUserMappings(m, uuids, users)
+    l.extend(tail)
+    return tail
+
+
+def write_snapshot(dirname, l: list[QueryMatch], mtimes, uuids, users):
+    snapshot.write(f"{dirname}{SNAPSHOT_NAME}", l, {"groups": mtimes, "uuids": uuids, "users": users})
+
+
 def to_idx_key(s: str):
     return tuple(sorted([x.strip() for x in s.split(".") if x.strip()]))
 
@@ -226,22 +577,75 @@ def to_idx(s: str, l: list[QueryMatch], cs=None) -> list[QueryMatch]:
 
 
 def mid_idx(mids: list[int], l: list[QueryMatch]) -> list[QueryMatch]:
-    mids = sorted(mids)
-    
-    def pred(q: QueryMatch):
-        if not mids:
-            return False
-        if q.id == mids[0]:
-            mids.pop(0)
-            return True
-        return False
-    
-    l = [m for m in l if pred(m)]
+    return build_indexes({"": ("", mids)}, l)[""]
 
-    if mids:
-        print(f'Warning! Match ids not found while constructing index: {mids}')
 
-    return l
+# What each root index (besides __uuids/__users) holds: name -> (title, definition).
+# A definition is either a to_idx string or a list of match ids.
+# Only the to_idx ones get live matches (see apply_update).
+ROOT_INDEXES = {
+    "default": ("Default", "ranked.current.noabnormal"),
+    "all": ("All", ""),
+    "most": ("Most", "ranked.noabnormal"),
+    "matchanalysis": ("Match Analysis", "ranked.nodecay.noabnormal"),
+    "playoffs1": ("Ranked Playoffs 1", PLAYOFFS_SEASON_1),
+    "playoffs2": ("Ranked Playoffs 2", PLAYOFFS_SEASON_2),
+    "playoffs3": ("Ranked Playoffs 3", PLAYOFFS_SEASON_3),
+    "playoffs": ("Ranked Playoffs", PLAYOFFS),
+}
+
+IDX_FLAGS = {"ranked": 1, "nodecay": 2, "noabnormal": 4, "current": 8}
+
+
+def idx_flags(m: QueryMatch, cs) -> int:
+    return ((m.type == 2) | (not m.is_decay) << 1 | (not m.is_abnormal) << 2
+            | (m.season == cs) << 3)
+
+
+def build_indexes(defs: dict, l: list[QueryMatch], cs=None) -> dict[str, list[QueryMatch]]:
+    """
+    Builds every index in defs (see ROOT_INDEXES) in one pass over l.
+    An index without any filters is l itself.
+    """
+    res: dict[str, list[QueryMatch]] = dict()
+    by_flags: list[tuple[int, list]] = list()
+    by_id: dict[int, list[list]] = dict()
+    for name, (_, d) in defs.items():
+        if type(d) == str:
+            key = to_idx_key(d)
+            for f in key:
+                if f not in IDX_FLAGS:
+                    raise RuntimeError(f"Unknown index filter {f} in {name} (valid: {list(IDX_FLAGS.keys())})")
+            flags = sum([IDX_FLAGS[f] for f in key])
+            if flags == 0:
+                res[name] = l
+                continue
+            res[name] = list()
+            by_flags.append((flags, res[name]))
+        else:
+            res[name] = list()
+            for mid in d:
+                by_id.setdefault(mid, list()).append(res[name])
+
+    found = set()
+    for m in l:
+        if by_flags:
+            mf = idx_flags(m, cs)
+            for flags, idx in by_flags:
+                if mf & flags == flags:
+                    idx.append(m)
+        idxs = by_id.get(m.id)
+        if idxs is not None:
+            found.add(m.id)
+            for idx in idxs:
+                idx.append(m)
+
+    for name, (_, d) in defs.items():
+        if type(d) != str:
+            missing = sorted(set(d) - found)
+            if missing:
+                print(f'Warning! Match ids not found while constructing index: {missing}')
+    return res
 
 
 def format_str(o: object):
@@ -254,11 +658,11 @@ def format_str(o: object):
     if type(o) == str:
         return o
     if type(o) == UUID:
-        if _datasets_ is not None:
+        if _version_ is not None:
             try:
                 if __discord:
-                    return _datasets_["__uuids"].l[o].replace("_", "\\_")
-                return _datasets_["__uuids"].l[o]
+                    return _version_.datasets["__uuids"].l[o].replace("_", "\\_")
+                return _version_.datasets["__uuids"].l[o]
             except KeyError:
                 raise KeyError(f"{o} is not a valid username.")
     if type(o) == Milliseconds:
@@ -275,14 +679,37 @@ class Dataset:
     def __init__(self, name: str, l, root=False):
         self.l = l
         self.name = name
+        # Root indexes are shared by every query, and never changed.
+        self.root = root
         self.has_unranked: bool = True
+        # Only for root indexes of matches, see index_players.
+        self.postings: Postings | None = None
+        # Only for root indexes of matches, see keep_orders.
+        self.orders: SortOrders | None = None
+        # Only for root indexes of matches, see keep_bitmaps.
+        self.bitmaps: Bitmaps | None = None
+        # Only for root indexes of matches, see season_index.
+        self.seasons: dict[int, Dataset] | None = None
         if root and isinstance(self.l, list):
             if self.l and isinstance(self.l[0], QueryMatch):
                 # if all matches are ranked
                 if all([m.is_ranked() for m in l]):
                     self.has_unranked = False
 
+    @property
+    def l(self):
+        prefix = self.prefix
+        return self._l if prefix is None else prefix.l
+
+    @l.setter
+    def l(self, l):
+        self._l = l
+        # Only for versions of root indexes, see updated.
+        self.prefix: Prefix | None = None
+
     def __len__(self):
+        if self.prefix is not None:
+            return self.prefix.n
         if type(self.l) in SUPPORTED_ITERABLES:
             return len(self.l)
         return 1
@@ -300,20 +727,88 @@ class Dataset:
         d.has_unranked = self.has_unranked
         return d
 
-    def update(self, other: list[QueryMatch]):
-        last_mid = self.l[-1].id
-        # ensure we don't get duplicate matches
-        ilen = len(other)
-        other = [m for m in other if m.id > last_mid]
-        print(f"removed {ilen - len(other)} matches from update (dupes)")
-        self.l.extend(other)
+    def updated(self, other: list[QueryMatch], has_unranked: bool):
+        """
+        The next version, with other added. Every version shares one list (see
+        prefix.py), and orders & bitmaps catch up when a query needs them, so
+        this only costs as much as other. Only the newest version gets updated.
+        """
+        if self.prefix is None:
+            self.prefix = Prefix.of(self._l)
+        start = self.prefix.n
+        d = Dataset(self.name, None)
+        d.prefix = self.prefix.grown(other)
+        d.root = self.root
+        d.has_unranked = self.has_unranked or has_unranked
+        if self.postings is not None:
+            self.postings.add(other, start)
+            d.postings = self.postings
+        if self.orders is not None:
+            d.orders = self.orders.updated(d.prefix, other, start)
+        if self.bitmaps is not None:
+            d.bitmaps = self.bitmaps.updated(d.prefix, start)
+        if self.seasons is not None:
+            d.seasons = dict(self.seasons)
+            for season, idx in by_season(other).items():
+                prev = d.seasons.get(season)
+                d.seasons[season] = self.keeping(Dataset(f"Season {season}", idx, root=True)) if prev is None else prev.updated(idx, has_unranked)
+        return d
 
-    def update_overwrite_dict(self, other: dict[str, str]):
-        for k, v in other.items():
-            self.l[k] = v
+    def index_players(self):
+        self.postings = Postings(self.l)
+        return self
+
+    def keep_orders(self):
+        # Sorts of this index are kept (built when first needed), see orders.py.
+        self.orders = SortOrders(self.prefix or self.l)
+        return self
+
+    def keep_bitmaps(self):
+        # Filters on flags & co. are answered from bitmaps (built when first needed), see bitmaps.py.
+        self.bitmaps = Bitmaps(self.prefix or self.l)
+        return self
+
+    def keeping(self, d: "Dataset"):
+        # d, keeping whatever this keeps (postings, orders, bitmaps).
+        if self.postings is not None:
+            d.index_players()
+        if self.orders is not None:
+            d.keep_orders()
+        if self.bitmaps is not None:
+            d.keep_bitmaps()
+        return d
+
+    def season_index(self, season: int) -> "Dataset | None":
+        """
+        The matches of this index from season, as a root index of their own.
+        Every season's is built the first time any of them is needed, and live
+        matches are added to them (see updated). None if there are no matches
+        from season.
+        """
+        if self.seasons is None:
+            self.seasons = {season: self.keeping(Dataset(f"Season {season}", idx, root=True)) for season, idx in by_season(self.l).items()}
+        return self.seasons.get(season)
+
+    def updated_dict(self, other: dict[str, str]):
+        """
+        For __uuids/__users. Older versions share the dict, and the newer one only
+        gets its own copy of what was added since it was last merged (see merged_dict).
+        """
+        added, base = (self.l.maps[0], self.l.maps[1]) if isinstance(self.l, ChainMap) else (dict(), self.l)
+        added = added | other
+        if len(added) * DICT_OVERLAY_RATIO > len(base):
+            # Merging costs as much as the whole dict, so only every so often.
+            return self.clone(base | added)
+        return self.clone(ChainMap(added, base))
+
+    def merged_dict(self) -> dict:
+        # A plain dict of what updated_dict added on. From now on this version shares it.
+        if isinstance(self.l, ChainMap):
+            self.l = dict(self.l)
+        return self.l
 
     def info(self):
-        if type(self.l) in [list, dict]:
+        if type(self.l) in [list, dict, ChainMap]:
             return f"Dataset {self.name}, currently with {len(self.l)} objects."
         return f"Dataset containing {format_str(self.l)}"
 
@@ -326,7 +821,7 @@ class Dataset:
                 return formatter["clean"](s)
             return s
         val = self.l
-        if type(val) == dict:
+        if type(val) in [dict, ChainMap]:
             val = list(val.items())
         if isinstance(val, list):
             length = len(val)
@@ -345,7 +840,7 @@ class Dataset:
     def example(self):
         if type(self.l) in SUPPORTED_ITERABLES:
             try:
-                if type(self.l) == dict:
+                if type(self.l) in [dict, ChainMap]:
                     return first_not_none(list(self.l.values()))
                 return first_not_none(self.l)
             except:
@@ -353,6 +848,73 @@ class Dataset:
         return self.l
 
 
+class Selection(Dataset):
+    """
+    Part of a root index: the positions (in index order) of the matches that
+    the filters before it kept. The matches themselves are only looked up if
+    something needs .l, which lets count, sort & co. work from the positions.
+    """
+
+    def __init__(self, source: Dataset, positions: array):
+        self.source = source
+        self.positions = positions
+        self._l: list | None = None
+        super().__init__(source.name, None)
+        self.has_unranked = source.has_unranked
+
+    @property
+    def l(self):
+        if self._l is None:
+            index = self.source.l
+            self._l = [index[p] for p in self.positions]
+        return self._l
+
+    @l.setter
+    def l(self, value):
+        self._l = value
+
+    def __len__(self):
+        return len(self.positions)
+
+
+class Stream:
+    """
+    The contents of a list Dataset that haven't been worked out yet (see Executor.streamer).
+    Has example() and iter() like a Dataset, so extractors can be set up from the start
+    of it. Anything those look at is kept, and rest() starts from the beginning again.
+    """
+
+    def __init__(self, it: Iterator, dataset: Dataset | None = None):
+        self.it = it
+        self.seen: list = list()
+        # The Dataset this is all of, if any.
+        self.dataset = dataset
+
+    def iter(self):
+        i = 0
+        while True:
+            if i == len(self.seen):
+                try:
+                    self.seen.append(next(self.it))
+                except StopIteration:
+                    return
+            yield self.seen[i]
+            i += 1
+
+    def example(self):
+        return first_not_none(self.iter())
+
+    def first(self) -> tuple[bool, Any]:
+        # (False, None) if there is nothing at all.
+        for x in self.iter():
+            return True, x
+        return False, None
+
+    def rest(self) -> Iterator:
+        seen, self.seen = self.seen, list()
+        return chain(seen, self.it)
+
+
 class UUIDDataset:
     def __init__(self, users_to_uuids: Dataset, uuids_to_users: Dataset) -> None:
         self.users_to_uuids = users_to_uuids.l
@@ -375,14 +937,18 @@ def AsMostDatalist(l: list[QueryMatch]):
     return to_idx("ranked.noabnormal", l)
 
 
+def AddUserMappings(m: QueryMatch, uuids: dict, users: dict):
+    for p in m.members:
+        assert type(p) == MatchMember
+        users[p.user.lower()] = p.uuid
+        uuids[p.uuid] = p.user
+
+
 def GetUserMappings(l: list[QueryMatch]):
     uuids = {}
     users = {}
     for m in l:
-        for p in m.members:
-            assert type(p) == MatchMember
-            users[p.user.lower()] = p.uuid
-            uuids[p.uuid] = p.user
+        AddUserMappings(m, uuids, users)
     uuids["__draw"] = "Drawn Match"
     uuids["__decay"] = "Decayed Match"
     users["drawn match"] = "__draw"
@@ -391,68 +957,64 @@ def GetUserMappings(l: list[QueryMatch]):
 
 
 def cleanup_matches(l: list[QueryMatch]):
-    for i, m in enumerate(l):
-        # Fix tagged playoffs matches
-        if m.type == 3 and m.spectated and m.tag is not None:
-            # Private match. Maybe tag propagation required.
-            # Grab last hour / next hour and check.
-            ONE_HOUR = 60 * 60
-
-            # Back scan.
-            loc = i
-            while loc > 0:
-                loc -= 1
-                pm = l[loc]
-                if (m.date - pm.date) > ONE_HOUR:
-                    break
-                if pm.type != 3 or not pm.spectated or pm.tag is not None:
-                    continue
-                if pm.members == m.members:
-                    pm.tag = m.tag
+    """
+    Fix tagged playoffs matches: private, spectated matches between the same players
+    within an hour of a tagged one get its tag, if they don't have one yet.
+    Tags spread forwards in a chain (a match that got a tag passes it on), as we go in order.
+    """
+    ONE_HOUR = 60 * 60
 
-            # Forward scan.
-            loc = i
-            while loc < len(l) - 1:
-                loc += 1
-                pm = l[loc]
-                if (pm.date - m.date) > ONE_HOUR:
-                    break
-                if pm.type != 3 or not pm.spectated or pm.tag is not None:
-                    continue
-                if pm.members == m.members:
+    # (member set, hour) -> indices of candidate matches, in order.
+    buckets: dict[tuple[tuple, int], list[int]] = dict()
+    keys: dict[int, tuple] = dict()
+    for i, m in enumerate(l):
+        if m.type == 3 and m.spectated:
+            key = m.members.basic_repr()
+            keys[i] = key
+            buckets.setdefault((key, m.date // ONE_HOUR), list()).append(i)
+
+    for i, key in keys.items():
+        m = l[i]
+        if m.tag is None:
+            continue
+        # Private match. Maybe tag propagation required.
+        # Grab last hour / next hour and check.
+        hour = m.date // ONE_HOUR
+        for b in (hour - 1, hour, hour + 1):
+            for j in buckets.get((key, b), ()):
+                pm = l[j]
+                if pm.tag is None and abs(pm.date - m.date) <= ONE_HOUR:
                     pm.tag = m.tag
     return l
 
 
+def get_partitions() -> PartitionCache | None:
+    return PARTITIONS
+
+
 def load_defaults(p: str, quiet=False, set_discord=False, no_mq=False):
     global __discord
     if set_discord:
         __discord = True
-    global _datasets_
-    if _datasets_ is None:
+    if _version_ is None:
         if not no_mq:
+            # Anything it receives while we load waits until there is a version.
             print("Starting RabbitMQ consumer.")
             _mq_.start_consuming()
-            print("Finished loading RabbitMQ consumer.")
-        l = cleanup_matches(load_raw_matches(p, quiet))
-        uuids, users = GetUserMappings(l)
-        _datasets_ = {
-            "default": Dataset("Default", AsDefaultDatalist(l, l[-1].season), root=True),
-            "all": Dataset("All", l, root=True),
-            "most": Dataset("Most", AsMostDatalist(l), root=True),
-            "matchanalysis": Dataset("Match Analysis", to_idx("ranked.nodecay.noabnormal",l), root=True),
-            "playoffs1": Dataset("Ranked Playoffs 1", mid_idx(PLAYOFFS_SEASON_1, l), root=True),
-            "playoffs2": Dataset("Ranked Playoffs 2", mid_idx(PLAYOFFS_SEASON_2, l), root=True),
-            "playoffs3": Dataset("Ranked Playoffs 3", mid_idx(PLAYOFFS_SEASON_3, l), root=True),
-            "playoffs": Dataset("Ranked Playoffs", mid_idx(PLAYOFFS, l), root=True),
-            "__uuids": Dataset("UUIDs", uuids, root=True),
-            "__users": Dataset("Users", users, root=True),
-        }
-        global CURRENT_SEASON
-        CURRENT_SEASON = l[-1].season
-
-    if not no_mq:
-        # first, pull new matches from rmq
-        _mq_.update_datasets()
-
-    return _datasets_
+        cache_dir = p if CACHE_DIR is None else CACHE_DIR
+        l, uuids, users = load_matches(p, quiet, workers=LOAD_WORKERS, cache_dir=cache_dir)
+        idxs = build_indexes(ROOT_INDEXES, l, l[-1].season)
+        datasets = {name: Dataset(title, idxs[name], root=True).index_players().keep_orders().keep_bitmaps() for name, (title, _) in ROOT_INDEXES.items()}
+        datasets["__uuids"] = Dataset("UUIDs", uuids, root=True)
+        datasets["__users"] = Dataset("Users", users, root=True)
+        global PARTITIONS
+        PARTITIONS = PartitionCache(cache_dir, PARTITION_BUDGET)
+        global JOURNAL
+        JOURNAL = Journal(f"{cache_dir}{JOURNAL_NAME}")
+        publish(DatasetVersion(0, datasets, l[-1].season))
+
+    if not no_mq and _mq_.error is not None:
+        error, _mq_.error = _mq_.error, None
+        raise RuntimeError(error)
+
+    return _version_.datasets
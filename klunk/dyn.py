@@ -79,5 +79,8 @@ def finish_query():
     for name, f in finishes:
         __dyn[name] = f()
         print(json.dumps(__dyn[name], indent=2))
+    # These are finished for good - later loads (e.g. stale snapshot groups) must not rerun them.
+    todos.clear()
+    finishes.clear()
     with open("dyn.json", "w") as file:
         json.dump(__dyn, file)
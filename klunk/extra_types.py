@@ -7,7 +7,8 @@ class Seconds(int):
 
 
 class UUID(str):
-    pass
+    # Loaded uuids are shared through store.PLAYERS, so there is one of these per player.
+    __slots__ = ()
 
 
 def is_numeric(T):
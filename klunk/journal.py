@@ -0,0 +1,49 @@
+"""
+Append-only journal of live matches (see PikaConnection.update_datasets), so that
+a restart only has to replay what arrived since the last snapshot.
+
+Each record is a little-endian u32 length followed by that many bytes: the
+message as it came off the queue ("match_id|json"). A record that was cut short
+(by a crash half way through an append) ends the journal, and is cut off the
+file the next time it is read.
+"""
+import os
+import struct
+
+_length = struct.Struct("<I")
+
+
+class Journal:
+    def __init__(self, path: str):
+        self.path = path
+
+    def append(self, records: list[bytes]):
+        with open(self.path, "ab") as file:
+            file.write(b"".join([_length.pack(len(r)) + r for r in records]))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def records(self) -> list[bytes]:
+        if not os.path.isfile(self.path):
+            return list()
+        with open(self.path, "rb") as file:
+            data = file.read()
+        res: list[bytes] = list()
+        pos = 0
+        while pos + _length.size <= len(data):
+            (length,) = _length.unpack_from(data, pos)
+            if pos + _length.size + length > len(data):
+                break
+            pos += _length.size
+            res.append(data[pos : pos + length])
+            pos += length
+        if pos != len(data):
+            print(f"Journal {self.path} ends with a partial record, dropping its last {len(data) - pos} bytes.")
+            os.truncate(self.path, pos)
+        return res
+
+    def size(self) -> int:
+        return os.path.getsize(self.path) if os.path.isfile(self.path) else 0
+
+    def clear(self):
+        open(self.path, "wb").close()
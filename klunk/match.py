@@ -1,7 +1,12 @@
+from array import array
+from collections import OrderedDict
+from sys import intern
+from threading import RLock
 from typing import Any, Callable, Optional
 
 from .parse import parse_boolean
 from .extra_types import *
+from .store import PID_DECAY, PID_DRAW, PLAYERS, SPLITS, STORE
 
 ABNORMAL_MATCH_MS = 6 * 60 * 1000
 IMPOSSIBLE_MATCH_MS = 4 * 60 * 1000
@@ -24,7 +29,7 @@ def is_abnormal(m) -> bool:
         return False
 
     # If the winner is NOT a valid member, then this is glitched.
-    if m.winner not in [x.uuid for x in m.members]:
+    if m.winner_pid not in [x.pid for x in m.members]:
         return True
 
     # If the duration is WAY TOO SHORT, *always* exit out.
@@ -64,8 +69,9 @@ def _extract(t, k, *args):
 
 
 class MatchMember:
+    attributes = ("uuid", "user", "badge", "old_elo", "old_rank", "elo", "change", "elo_after")
     __slots__ = (
-        "uuid",  # uuid: str (UUID... obviously)
+        "pid",  # uuid: int (id in PLAYERS, see the uuid property)
         "user",  # nickname: str
         "badge",  # badge: int
         "old_elo",  # elo_rate: int (*)
@@ -76,8 +82,8 @@ class MatchMember:
     )
 
     def __init__(self, match_member: dict[str, Any]):
-        self.uuid: str = UUID(match_member["uuid"])
-        self.user: str = match_member["nickname"]
+        self.pid: int = PLAYERS.id(match_member["uuid"])
+        self.user: str = intern(match_member["nickname"])
         self.badge: int = match_member.get('badge', match_member.get('roleType'))
         self.old_elo: int = match_member["elo_rate"]
         self.old_rank: int = match_member["elo_rank"]
@@ -88,6 +94,25 @@ class MatchMember:
     def extract(self, attribute, *args):
         return _extract(self, attribute, *args)
 
+    @property
+    def uuid(self) -> UUID:
+        return PLAYERS.uuids[self.pid]
+
+    @uuid.setter
+    def uuid(self, value: str):
+        self.pid = PLAYERS.id(value)
+
+    def to_row(self):
+        # Player ids are only valid in this process, so rows carry the uuid itself.
+        return (self.uuid, self.user, self.badge, self.old_elo, self.old_rank, self.elo, self.change, self.elo_after)
+
+    @staticmethod
+    def from_row(row):
+        mem = MatchMember.__new__(MatchMember)
+        uuid, mem.user, mem.badge, mem.old_elo, mem.old_rank, mem.elo, mem.change, mem.elo_after = row
+        mem.pid = PLAYERS.id(uuid)
+        return mem
+
     def __str__(self):
         return f"{self.user}"
 
@@ -109,7 +134,7 @@ class Timeline:
     def __init__(self, timeline):
         self.time: Milliseconds = Milliseconds(timeline["time"])
         self.id: str = timeline["timeline"]
-        self.uuid: UUID = UUID(timeline["uuid"])
+        self.uuid: UUID = PLAYERS.uuid(timeline["uuid"])
 
     @staticmethod
     def from_items(time, id, uuid):
@@ -119,6 +144,17 @@ class Timeline:
     def custom(uuid, name, time):
         return Timeline.from_items(uuid=uuid, id=f'rql.{name}', time=time)
 
+    def to_row(self):
+        return (int(self.time), intern(self.id), PLAYERS.id(self.uuid))
+
+    @staticmethod
+    def from_row(row):
+        tl = Timeline.__new__(Timeline)
+        time, tl.id, pid = row
+        tl.time = Milliseconds(time)
+        tl.uuid = PLAYERS.uuids[pid]
+        return tl
+
     def __repr__(self):
         return f"Timeline({self.time}, {self.id}, {self.uuid})"
 
@@ -140,8 +176,9 @@ def _lextract(tl, k):
 
 class UUIDList(list):
     def get(self, uuid: UUID) -> MatchMember | None:
+        pid = PLAYERS.ids.get(uuid)
         for mem in self:
-            if mem.uuid == uuid:
+            if mem.pid == pid:
                 return mem
         return None
 
@@ -151,7 +188,7 @@ class UUIDList(list):
         return _lextract(self, key)
 
     def basic_repr(self):
-        return "".join(sorted([m.uuid for m in self]))
+        return tuple(sorted([m.pid for m in self]))
 
     def __str__(self):
         return f'UUIDList ({len(self)} elements): {", ".join([str((m.uuid, m.user)) for m in self])}'
@@ -167,14 +204,21 @@ class UUIDList(list):
 class TimelineList(list):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # The lookup covers what we were constructed with, and is only built if someone asks.
+        self._indexed = len(self)
+        self._lookup: dict[str, list[Timeline]] | None = None
 
+    @property
+    def lookup(self) -> dict[str, list[Timeline]]:
         # Generate a special lookup dictionary.
-        self.lookup: dict[str, list[Timeline]] = dict()
-        for tl in self:
-            assert isinstance(tl, Timeline)
-            if tl.id not in self.lookup:
-                self.lookup[tl.id] = list()
-            self.lookup[tl.id].append(tl)
+        if self._lookup is None:
+            self._lookup = dict()
+            for tl in self[: self._indexed]:
+                assert isinstance(tl, Timeline)
+                if tl.id not in self._lookup:
+                    self._lookup[tl.id] = list()
+                self._lookup[tl.id].append(tl)
+        return self._lookup
 
     def extract(self, key: str):
         return _lextract(self, key)
@@ -189,6 +233,18 @@ class TimelineList(list):
         return self.lookup.get(tl_id, list())
 
 
+# Decoded TimelineLists by STORE row, least recently used first.
+TIMELINE_CACHE_SIZE = 4096
+_timeline_cache: OrderedDict[int, TimelineList] = OrderedDict()
+# Queries and the consumer thread (and __del__, from either) all use it. Reentrant,
+# as a match collected while we hold it drops its entry on the same thread.
+_timeline_cache_lock = RLock()
+
+
+# Shared by every match without timelines. Never modified.
+NO_TIMELINES = array("i")
+
+
 def SortBy(l, q, r=False):
     if not l:
         return list()
@@ -197,8 +253,26 @@ def SortBy(l, q, r=False):
     return sorted(l, key=lambda v: getattr(v, q), reverse=r)
 
 
+def _column(name: str, wrap: Callable):
+    # A QueryMatch attribute that lives in the columnar match store (see store.py).
+    column = getattr(STORE, name)
+
+    def get(self):
+        return wrap(column[self._row])
+
+    def set(self, value):
+        column[self._row] = value
+
+    return property(get, set)
+
+
+DRAW_UUID = PLAYERS.uuids[PID_DRAW]
+DECAY_UUID = PLAYERS.uuids[PID_DECAY]
+
+
 class QueryMatch:
-    __slots__ = (  # Mostly direct match keys.
+    # Everything a match has. Most of these are slots, the rest are columns in STORE.
+    attributes = (  # Mostly direct match keys.
         "id",  # match_id: int
         "seed_type",  # seed_type: str
         "type",  # match_type: int
@@ -223,6 +297,150 @@ class QueryMatch:
         "spectated",
         "bastion",
     )
+    __slots__ = (
+        "_row",  # Our row in STORE.
+        "_timelines",  # Packed timelines, see pack_timelines.
+        "members",
+        "category",
+        "scored",
+        "has_elos",
+        "was_fixed",
+        "dynamic",
+        "tag",
+        "spectated",
+        "bastion",
+    )
+
+    id = _column("id", int)
+    type = _column("type", int)
+    duration = _column("duration", Milliseconds)
+    date = _column("date", Seconds)
+    season = _column("season", int)
+    is_ff = _column("is_ff", bool)
+    is_decay = _column("is_decay", bool)
+    is_abnormal = _column("is_abnormal", bool)
+
+    @property
+    def seed_type(self) -> Optional[str]:
+        return STORE.seed_types[STORE.seed_type[self._row]]
+
+    @seed_type.setter
+    def seed_type(self, value: Optional[str]):
+        STORE.seed_type[self._row] = STORE.seed_type_code(value)
+
+    @property
+    def winner(self) -> UUID:
+        return PLAYERS.uuids[STORE.winner[self._row]]
+
+    @winner.setter
+    def winner(self, value: UUID):
+        STORE.winner[self._row] = PLAYERS.id(value)
+
+    @property
+    def winner_pid(self) -> int:
+        return STORE.winner[self._row]
+
+    @property
+    def timelines(self) -> "TimelineList":
+        """
+        Timelines are kept as (time, id, player id) rows sorted by time, and only turned into
+        Timeline objects when something asks for them. Most queries never do.
+        """
+        with _timeline_cache_lock:
+            tls = _timeline_cache.get(self._row)
+            if tls is not None:
+                _timeline_cache.move_to_end(self._row)
+                return tls
+        tls = self.decode_timelines()
+        with _timeline_cache_lock:
+            _timeline_cache[self._row] = tls
+            if len(_timeline_cache) > TIMELINE_CACHE_SIZE:
+                _timeline_cache.popitem(last=False)
+        return tls
+
+    def pack_timelines(self, rows):
+        """
+        rows: (time, split id, uuid), sorted by time. Stored as one array('i') of three
+        parallel runs: times, split codes (SPLITS), and players. A player is an index into
+        members, or -1 - pid for the odd timeline of a non-member.
+        """
+        if not rows:
+            self._timelines = NO_TIMELINES
+            return
+        # Plain dict lookups first, as this runs for every timeline we load.
+        codes = [SPLITS.ids.get(split) for _, split, _ in rows]
+        if None in codes:
+            codes = [SPLITS.id(split) for _, split, _ in rows]
+        players = [PLAYERS.ids.get(uuid) for _, _, uuid in rows]
+        if None in players:
+            players = [PLAYERS.id(uuid) for _, _, uuid in rows]
+        pids = [mem.pid for mem in self.members]
+        packed = array("i", [time for time, _, _ in rows])
+        packed.extend(codes)
+        packed.extend([pids.index(pid) if pid in pids else -1 - pid for pid in players])
+        self._timelines = packed
+
+    def timeline_count(self) -> int:
+        return len(self._timelines) // 3
+
+    def timeline_pid(self, i: int) -> int:
+        # Player id of the i-th timeline.
+        n = len(self._timelines) // 3
+        ref = self._timelines[2 * n + i]
+        return self.members[ref].pid if ref >= 0 else -1 - ref
+
+    def timeline_rows(self):
+        # Yields (time, split code, player id) for every timeline, in time order.
+        packed = self._timelines
+        n = len(packed) // 3
+        for i in range(n):
+            yield packed[i], packed[n + i], self.timeline_pid(i)
+
+    def find_timeline(self, split: str, pid: int | None = None) -> int | None:
+        """
+        Index of the earliest timeline with this split id (and player, if given), or None.
+        """
+        code = SPLITS.ids.get(split)
+        if code is None:
+            return None
+        packed = self._timelines
+        n = len(packed) // 3
+        i = n
+        while True:
+            try:
+                i = packed.index(code, i, 2 * n)
+            except ValueError:
+                return None
+            if pid is None or self.timeline_pid(i - n) == pid:
+                return i - n
+            i += 1
+
+    def get_timeline(self, i: int) -> Timeline:
+        packed = self._timelines
+        n = len(packed) // 3
+        return Timeline.from_row((packed[i], SPLITS.values[packed[n + i]], self.timeline_pid(i)))
+
+    def decode_timelines(self) -> "TimelineList":
+        tls = TimelineList([self.get_timeline(i) for i in range(self.timeline_count())])
+        # Not part of the lookup, as these were never real splits.
+        if tls and self.rql_completed():
+            tls.append(Timeline.custom(uuid=self.winner, name='completed', time=self.duration))
+            for member in self.get_other_members(self.winner):
+                tls.append(Timeline.custom(uuid=member.uuid, name='lost', time=self.duration))
+        return tls
+
+    def __del__(self):
+        # Give our row back to the store. _row is unset if we never got one.
+        try:
+            with _timeline_cache_lock:
+                _timeline_cache.pop(self._row, None)
+            STORE.release(self._row)
+        except AttributeError:
+            pass
+
+    def __reduce__(self):
+        # Copies (and pickles) need a row of their own, so go through to_row rather than copying _row.
+        return QueryMatch.from_row, (self.to_row(),), (None, {"dynamic": self.dynamic})
 
     @staticmethod
     def filter_value(a, b, uuidmap):
@@ -241,7 +459,7 @@ class QueryMatch:
         from .translations import MatchVariablesDict as tl
 
         a = tl.get(a, a)
-        if a not in self.__slots__:
+        if a not in self.attributes:
             raise ValueError(f"{a} is not a valid match filter.")
 
         # id: basic
@@ -252,6 +470,8 @@ class QueryMatch:
         return func(self.extract(a))
 
     def __init__(self, m):
+        self._row = STORE.alloc()
+
         # Important early things
 
         # This is mapped by the fetcher. Actual key: "decayed"
@@ -265,7 +485,7 @@ class QueryMatch:
         # YIKES.
         self.bastion: str = m.get("bastionType", None)
         self.type: int = m["match_type"]  # FILTER: Translation
-        self.winner: UUID = UUID(m["winner"]) if m["winner"] is not None else (UUID("__draw") if not m["is_decay"] else UUID("__decay"))
+        self.winner: UUID = m["winner"] if m["winner"] is not None else (DRAW_UUID if not m["is_decay"] else DECAY_UUID)
         self.members = UUIDList([MatchMember(mem) for mem in m["members"]])
         self.duration: Milliseconds = Milliseconds(m["final_time"])
         self.is_ff = m["forfeit"]
@@ -274,7 +494,7 @@ class QueryMatch:
         self.category: str = m.get("category", "UNKNOWN")
         assert self.is_decay is not None
         # TIMELINE LIST IS SORTED BY DEFAULT. THIS IS A GOOD THING.
-        self.timelines = TimelineList(sorted([Timeline(tl) for tl in (m["timelines"] or list())], key=lambda tl: tl.time))
+        self.pack_timelines(sorted([(tl["time"], tl["timeline"], tl["uuid"]) for tl in (m["timelines"] or list())], key=lambda tl: tl[0]))
         self.dynamic: None | dict = None
         self.tag: str | None = m.get("tag")
         
@@ -282,15 +502,11 @@ class QueryMatch:
 
         self.scored = m["score_changes"] is not None and len(m["score_changes"]) > 0
         self.was_fixed = False
-        if "timelines" in m and m["timelines"]:
-            s = max([t["time"] for t in m["timelines"]])
+        if self._timelines:
+            s = self._timelines[self.timeline_count() - 1]
             if s > self.duration:
                 self.was_fixed = True
                 self.duration = s
-            if self.rql_completed():
-                self.timelines.append(Timeline.custom(uuid=self.winner, name='completed', time=self.duration))
-                for member in self.get_other_members(self.winner):
-                    self.timelines.append(Timeline.custom(uuid=member.uuid, name='lost', time=self.duration))
 
         self.is_abnormal = False
         # Checking for abnormal matches.
@@ -316,14 +532,53 @@ class QueryMatch:
                     s.elo_after = p["score"] + p["change"]
                 s.change = p["change"]
 
+    def to_row(self):
+        """
+        Flattens the match into a tuple of plain values for snapshot.py.
+        Everything computed in __init__ is kept, so from_row skips all of that work.
+        """
+        return (
+            self.id,
+            self.seed_type,
+            self.type,
+            self.winner,
+            tuple(mem.to_row() for mem in self.members),
+            int(self.duration),
+            self.is_ff,
+            self.season,
+            self.category,
+            int(self.date),
+            self.is_decay,
+            tuple((time, SPLITS.values[code], PLAYERS.uuids[pid]) for time, code, pid in self.timeline_rows()),
+            self.scored,
+            self.has_elos,
+            self.was_fixed,
+            self.is_abnormal,
+            self.tag,
+            self.spectated,
+            self.bastion,
+        )
+
+    @staticmethod
+    def from_row(row):
+        m = QueryMatch.__new__(QueryMatch)
+        m._row = STORE.alloc()
+        (m.id, m.seed_type, m.type, winner, members, m.duration, m.is_ff, m.season, m.category, m.date, m.is_decay,
+         timelines, m.scored, m.has_elos, m.was_fixed, m.is_abnormal, m.tag, m.spectated, m.bastion) = row
+        m.winner = winner
+        m.members = UUIDList([MatchMember.from_row(mem) for mem in members])
+        m.pack_timelines(timelines)
+        m.dynamic = None
+        return m
+
     def rql_split_time(self, split: str, uuid: str):
-        l = [t for t in self.timelines.all(split) if t.uuid == uuid]
-        if not l:
+        tl = self.earliest(split, uuid)
+        if tl is None:
             return None
-        return min(l, key=lambda t: t.time).time
+        return tl.time
 
     def rql_is_draw(self):
-        return self.winner == "__draw"
+        return STORE.winner[self._row] == PID_DRAW
 
     def rql_loser(self):
         return self.get_other_member(self.winner).uuid
@@ -358,20 +613,23 @@ class QueryMatch:
     def get_member(self, uuid):
         # Note to self - this does UUID comparisons properly.
         # If this is crashing, you're probably checking corrupted matches.
+        pid = PLAYERS.ids.get(uuid)
         for m in self.members: # UUIDList
-            if m.uuid == uuid:
+            if m.pid == pid:
                 return m
         raise ValueError(f"Could not find uuid {uuid} in match ID {self.id}")
 
     def get_other_member(self, uuid):
         # assert uuid in [x.uuid for x in self.members]
+        pid = PLAYERS.ids.get(uuid)
         for m in self.members:
-            if m.uuid != uuid:
+            if m.pid != pid:
                 return m
         raise ValueError(f"Could not find other uuid for {uuid} in match ID {self.id}")
 
     def get_other_members(self, uuid) -> list[MatchMember]:
-        return [m for m in self.members if m.uuid != uuid]
+        pid = PLAYERS.ids.get(uuid)
+        return [m for m in self.members if m.pid != pid]
 
     def valid_elos(self):
         return [
@@ -388,7 +646,9 @@ class QueryMatch:
         return None
 
     def rql_winner_split_count(self, arg):
-        return len([tl for tl in self.timelines.all(arg) if tl.uuid == self.winner])
+        code = SPLITS.ids.get(arg)
+        winner = self.winner_pid
+        return len([1 for _, c, pid in self.timeline_rows() if c == code and pid == winner])
 
     def rql_loser_split_count(self, arg):
         loser = self.get_other_member(self.winner)
@@ -455,7 +715,7 @@ class QueryMatch:
         return self.type == 2
 
     def valid_timelines(self) -> bool:
-        return self.timelines is not None and len(self.timelines) > 0
+        return len(self._timelines) > 0
 
     def get_split(self, split: str):
         return self.timelines.get(split, None)
@@ -477,26 +737,18 @@ class QueryMatch:
         if not self.valid_timelines():
             return None
 
-        if split in self.timelines.lookup:
-            sd: list[Timeline] = self.timelines.lookup[split]
-            # List must be > 0 - otherwise it shouldn't be in the lookup.
-            assert len(sd) > 0
-
-            # player param must be a UUID. We don't do silly lookups here. Do that externally.
-            valid = [tl for tl in sd if player is None or tl.uuid == player]
-
-            # Same as before. Pretty useless asserts but leaving for now.
-            assert len(valid) > 0 or player is not None
-
-            # Split didn't exist.
-            if not valid:
+        # player param must be a UUID. We don't do silly lookups here. Do that externally.
+        pid = None
+        if player is not None:
+            pid = PLAYERS.ids.get(player)
+            if pid is None:
                 return None
 
-            # Get the earliest.
-            sorted_valid = sorted(valid, key=lambda tlo: tlo.time)
-            return sorted_valid[0]
-
-        return None
+        # Timelines are sorted by time, so the first one found is the earliest.
+        i = self.find_timeline(split, pid)
+        if i is None:
+            return None
+        return self.get_timeline(i)
 
 
 def iter(u, filt: Callable, *args):
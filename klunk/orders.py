@@ -0,0 +1,180 @@
+"""
+A root index sorted by the attributes that get sorted on all the time (sort
+duration, rsort date, sort id), so that sorting the index, or a big part of
+it that a filter kept, doesn't have to sort from scratch every query. Each
+order is built the first time someone sorts on it, and live matches are
+merged into it (see Dataset.updated) rather than sorting again.
+
+These are all STORE columns, so they're plain ints and never None.
+"""
+from array import array
+from bisect import bisect_right
+
+from .match import QueryMatch
+from .prefix import Prefix
+from .store import STORE
+
+ORDER_ATTRIBUTES = ("id", "date", "duration")
+
+# Only walk an order for a part of the index if it's at least this big a part.
+# Anything smaller is quicker to just sort.
+MIN_WALK_FRACTION = 8
+
+
+class SortOrder:
+    def __init__(self, keys: array, positions: array):
+        # positions: the index, sorted. keys[i] is what positions[i] is sorted by
+        # (the value, or minus it for reverse sorts).
+        self.keys = keys
+        self.positions = positions
+
+    @staticmethod
+    def build(l: list[QueryMatch], attribute: str, reverse: bool) -> "SortOrder":
+        column = getattr(STORE, attribute)
+        sign = -1 if reverse else 1
+        keys = [sign * column[m._row] for m in l]
+        # Stable, so equal values stay in index order, just like sorted() on the index.
+        positions = array("I", sorted(range(len(l)), key=keys.__getitem__))
+        return SortOrder(array("q", [keys[p] for p in positions]), positions)
+
+    def updated(self, other: list[QueryMatch], start: int, attribute: str, reverse: bool) -> "SortOrder":
+        # other are at positions start, start + 1... after everything we have, so they go after equal values.
+        column = getattr(STORE, attribute)
+        sign = -1 if reverse else 1
+        keys, positions = array("q", self.keys), array("I", self.positions)
+        for p, m in enumerate(other, start):
+            k = sign * column[m._row]
+            i = bisect_right(keys, k)
+            keys.insert(i, k)
+            positions.insert(i, p)
+        return SortOrder(keys, positions)
+
+
+class SortOrders:
+    """
+    The orders of one version of a root index. rows (STORE row -> position in
+    the index) only ever grows, so every version shares it. A new version
+    doesn't work out its orders until a query sorts on it: it starts from the
+    newest version's that had them (behind, see updated).
+    """
+
+    def __init__(self, l: list[QueryMatch] | Prefix, rows: array | None = None, behind: dict | None = None):
+        self.source = l if isinstance(l, Prefix) else Prefix.of(l)
+        self.orders: dict[tuple[str, bool], SortOrder] = dict()
+        self.rows = rows
+        # (attribute, reverse) -> (an order of an older version, how many positions it has).
+        self.behind: dict[tuple[str, bool], tuple[SortOrder, int]] = behind or dict()
+
+    @property
+    def l(self) -> list[QueryMatch]:
+        return self.source.l
+
+    def updated(self, source: list[QueryMatch] | Prefix, other: list[QueryMatch], start: int) -> "SortOrders":
+        # Queries can be building orders and rows on this version meanwhile, so look once.
+        rows = self.rows
+        behind = dict(self.behind)
+        for key, order in list(self.orders.items()):
+            behind[key] = (order, start)
+        res = SortOrders(source, rows, behind)
+        if rows is not None:
+            res.add_rows(rows, other, start)
+        return res
+
+    def order(self, attribute: str, reverse: bool) -> SortOrder:
+        key = (attribute, reverse)
+        order = self.orders.get(key)
+        if order is None:
+            if key in self.behind:
+                old, n = self.behind[key]
+                order = old.updated(self.l[n:], n, attribute, reverse)
+            else:
+                order = SortOrder.build(self.l, attribute, reverse)
+            self.orders[key] = order
+        return order
+
+    @staticmethod
+    def add_rows(rows: array, l: list[QueryMatch], start: int):
+        if len(rows) < len(STORE.id):
+            rows.extend(array("i", [-1]) * (len(STORE.id) - len(rows)))
+        for p, m in enumerate(l, start):
+            rows[m._row] = p
+
+    def row_positions(self) -> array:
+        rows = self.rows
+        if rows is None:
+            # Only shared once it's all there, see updated.
+            rows = array("i")
+            self.add_rows(rows, self.l, 0)
+            self.rows = rows
+        return rows
+
+    def positions(self, matches) -> array:
+        # Positions of matches, which must come from this version of the index (see Selection).
+        rows = self.row_positions()
+        return array("I", [rows[m._row] for m in matches])
+
+    def selected(self, l: list) -> bytearray | None:
+        # Which positions l is, if l is part of the index in index order (e.g. what a filter kept).
+        if not l or type(l[0]) is not QueryMatch:
+            return None
+        rows, index, n = self.row_positions(), self.l, len(self.l)
+        keep = bytearray(n)
+        prev = -1
+        try:
+            for m in l:
+                row = m._row
+                p = rows[row] if row < len(rows) else -1
+                if p <= prev or p >= n or index[p] is not m:
+                    return None
+                keep[p] = 1
+                prev = p
+        except AttributeError:
+            return None
+        return keep
+
+    def top(self, attribute: str, n: int, last: bool, reverse: bool, positions: array | None = None) -> list | None:
+        # The index (or the positions of it) sorted, then take [last] n.
+        if attribute not in ORDER_ATTRIBUTES:
+            return None
+        order = self.order(attribute, reverse).positions
+        if positions is None:
+            return [self.l[p] for p in (order[-n:] if last else order[:n])]
+        if len(positions) * MIN_WALK_FRACTION < len(self.l):
+            return None
+        keep = bytearray(len(self.l))
+        for p in positions:
+            keep[p] = 1
+        res = list()
+        for p in reversed(order) if last else order:
+            if keep[p]:
+                res.append(self.l[p])
+                if len(res) == n:
+                    break
+        return res[::-1] if last else res
+
+    def sorted(self, l: list, attribute: str, reverse: bool) -> list | None:
+        """
+        sorted(l, key=attribute, reverse=reverse), if l is the index or a big
+        enough part of it. None if it isn't.
+        """
+        if attribute not in ORDER_ATTRIBUTES:
+            return None
+        if l is self.l:
+            return [l[p] for p in self.order(attribute, reverse).positions]
+        if len(l) * MIN_WALK_FRACTION < len(self.l):
+            return None
+        keep = self.selected(l)
+        if keep is None:
+            return None
+        index = self.l
+        return [index[p] for p in self.order(attribute, reverse).positions if keep[p]]
+
+    def sorted_positions(self, positions: array, attribute: str, reverse: bool) -> list | None:
+        # Same as sorted, for the matches at positions (in index order).
+        if attribute not in ORDER_ATTRIBUTES or len(positions) * MIN_WALK_FRACTION < len(self.l):
+            return None
+        keep = bytearray(len(self.l))
+        for p in positions:
+            keep[p] = 1
+        index = self.l
+        return [index[p] for p in self.order(attribute, reverse).positions if keep[p]]
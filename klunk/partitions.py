@@ -0,0 +1,197 @@
+"""
+Seasons that get_skip_rule keeps out of memory are written to one snapshot per
+season instead of being thrown away, and loaded again when a query asks for them
+(`index sN`, `index all`). Loaded seasons (and all of them merged, for
+`index all`) are kept around until they push the cache over its budget (in
+matches), least recently used first. So is what `index sN` made of a loaded one.
+
+The matches that are always in memory (the current season, playoffs...) are
+never in here, so they can't be evicted.
+"""
+import heapq
+import os
+import re
+from collections import OrderedDict
+from operator import attrgetter
+from typing import Callable
+
+from . import snapshot
+from .match import QueryMatch
+
+PARTITION_PATTERN = re.compile(r"^rql-season-(\d+)\.snapshot$")
+
+# Key in PartitionCache.loaded of every partition merged together, see with_all.
+ALL_SEASONS = -1
+
+
+def partition_path(dirname: str, season: int):
+    return f"{dirname}rql-season-{season}.snapshot"
+
+
+def partition_seasons(dirname: str) -> list[int]:
+    res = list()
+    for f in os.listdir(dirname or "."):
+        match = PARTITION_PATTERN.match(f)
+        if match is not None:
+            res.append(int(match.group(1)))
+    return sorted(res)
+
+
+class PartitionWriter:
+    """
+    Collects skipped matches (in match id order) while group files are loaded,
+    writing each season out as it goes. Pass add as load_raw_matches' on_skip.
+    """
+
+    def __init__(self, dirname: str):
+        self.dirname = dirname
+        self.writers: dict[int, snapshot.Writer] = dict()
+
+    def add(self, m: QueryMatch):
+        writer = self.writers.get(m.season)
+        if writer is None:
+            writer = snapshot.Writer(partition_path(self.dirname, m.season), {"season": m.season})
+            self.writers[m.season] = writer
+        writer.add(m)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        # Anything we didn't just write is left over from older data.
+        for season in partition_seasons(self.dirname):
+            if season not in self.writers:
+                os.remove(partition_path(self.dirname, season))
+
+    def abort(self):
+        for writer in self.writers.values():
+            writer.abort()
+
+
+def add_to_partitions(dirname: str, matches: list[QueryMatch]):
+    # For the rare group file that changes after its partitions were written.
+    by_season: dict[int, list[QueryMatch]] = dict()
+    for m in matches:
+        by_season.setdefault(m.season, list()).append(m)
+    for season, new in by_season.items():
+        path = partition_path(dirname, season)
+        snap = snapshot.read(path)
+        old = [] if snap is None else snap[1]
+        known = set(m.id for m in old)
+        snapshot.write(path, sorted(old + [m for m in new if m.id not in known], key=lambda m: m.id), {"season": season})
+
+
+class PartitionCache:
+    def __init__(self, dirname: str, budget: int):
+        self.dirname = dirname
+        self.budget = budget
+        self.seasons = set(partition_seasons(dirname))
+        self.loaded: OrderedDict[int, list[QueryMatch]] = OrderedDict()
+        # (history, resident, both merged), see with_all.
+        self.merged: tuple[list, list, list] | None = None
+        # season -> (its partition, resident, both merged & picked), see with_season.
+        self.picked: dict[int, tuple[list, list, list]] = dict()
+
+    def __contains__(self, season: int):
+        return season in self.seasons
+
+    def size(self) -> int:
+        return sum([len(l) for l in self.loaded.values()])
+
+    def read(self, season: int) -> list[QueryMatch] | None:
+        snap = snapshot.read(partition_path(self.dirname, season))
+        if snap is None:
+            # Already printed why. Don't keep trying.
+            self.seasons.discard(season)
+            return None
+        print(f"Loaded season {season} partition ({len(snap[1])} matches).")
+        return snap[1]
+
+    def keep(self, key: int, l: list[QueryMatch]):
+        self.loaded[key] = l
+        # What we just loaded stays, even if it is over budget by itself.
+        while len(self.loaded) > 1 and self.size() > self.budget:
+            evicted, old = self.loaded.popitem(last=False)
+            if evicted == ALL_SEASONS:
+                self.merged = None
+                print(f"Evicted all partitions ({len(old)} matches).")
+            else:
+                self.picked.pop(evicted, None)
+                print(f"Evicted season {evicted} partition ({len(old)} matches).")
+
+    def get(self, season: int) -> list[QueryMatch]:
+        if season not in self.seasons:
+            return list()
+        if season in self.loaded:
+            self.loaded.move_to_end(season)
+            return self.loaded[season]
+        l = self.read(season)
+        if l is None:
+            return list()
+        self.keep(season, l)
+        return l
+
+    def with_season(self, season: int, resident: list[QueryMatch], pick: Callable[[list], list] | None = None) -> list[QueryMatch]:
+        """
+        All matches from season: its partition plus whatever of it is always in memory,
+        only the ones pick keeps (it has to look at each match by itself). Kept for as
+        long as the partition is, and until resident changes, like with_all.
+        """
+        part = self.get(season)
+        if pick is None:
+            pick = list
+        picked = self.picked.get(season)
+        if picked is not None and picked[0] is part:
+            _, old, res = picked
+            if resident is old:
+                return res
+            # Like with_all: a newer resident only has live matches on the end.
+            n = len(old)
+            if n <= len(resident) and (not n or resident[n - 1] is old[-1]):
+                new = pick([m for m in resident[n:] if m.season == season])
+                if not new or not res or new[0].id > res[-1].id:
+                    if new:
+                        res = res + new
+                    self.picked[season] = (part, resident, res)
+                    return res
+        res = pick(sorted(part + [m for m in resident if m.season == season], key=attrgetter("id")))
+        if season in self.loaded:
+            self.picked[season] = (part, resident, res)
+        return res
+
+    def history(self) -> list[QueryMatch]:
+        # Every partition in match id order. Kept like a season is, as big as all of them together.
+        if ALL_SEASONS in self.loaded:
+            self.loaded.move_to_end(ALL_SEASONS)
+            return self.loaded[ALL_SEASONS]
+        parts = list()
+        for season in sorted(self.seasons):
+            # Not through get, which could evict the ones we've got already.
+            part = self.loaded[season] if season in self.loaded else self.read(season)
+            if part is not None:
+                parts.append(part)
+        l = list(heapq.merge(*parts, key=attrgetter("id")))
+        self.keep(ALL_SEASONS, l)
+        return l
+
+    def with_all(self, resident: list[QueryMatch]) -> list[QueryMatch]:
+        """
+        Every match: the partitions plus resident. Kept for as long as the
+        partitions are, and until resident changes.
+        """
+        if not self.seasons:
+            return resident
+        history = self.history()
+        if self.merged is not None and self.merged[0] is history:
+            _, old, merged = self.merged
+            if resident is old:
+                return merged
+            # Usually a newer version of resident: the same matches, then live ones newer than everything.
+            n = len(old)
+            if n <= len(resident) and (not n or resident[n - 1] is old[-1]) and (n == len(resident) or not merged or resident[n].id > merged[-1].id):
+                if n < len(resident):
+                    merged = merged + resident[n:]
+                self.merged = (history, resident, merged)
+                return merged
+        merged = list(heapq.merge(history, resident, key=attrgetter("id")))
+        self.merged = (history, resident, merged)
+        return merged
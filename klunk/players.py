@@ -213,7 +213,7 @@ class PlayerManager:
                 if is_1v1 and opponent_above is not None:
                     other_player = next(rev_itr)
                     assert type(other_player) == match.MatchMember
-                    assert other_player.uuid != member.uuid
+                    assert other_player.pid != member.pid
                     assert other_player.elo is not None
                     if other_player.elo < opponent_above:
                         continue
@@ -221,7 +221,7 @@ class PlayerManager:
                 uuid = member.uuid
                 assert uuid is not None
                 if uuid not in self.players:
-                    self.players[uuid] = Player(member.user, UUID(uuid), m.date, member.elo_after)
+                    self.players[uuid] = Player(member.user, uuid, m.date, member.elo_after)
 
                 p = self.players[uuid]
 
@@ -241,7 +241,7 @@ class PlayerManager:
                 if not m.is_decay:
                     p.played_per[m.type] += 1
                     p.time_per[m.type] += m.duration
-                    if uuid == m.winner:
+                    if member.pid == m.winner_pid:
                         if m.is_ff:
                             p.ff_wins[m.type] += 1
                         else:  # CHANGED from ELIF type = 2
@@ -263,7 +263,7 @@ class PlayerManager:
                     if "nether_entries" not in p.dynamic:
                         p.dynamic["nether_entries"] = list()
                     assert type(m) == match.QueryMatch
-                    e = m.earliest("story.enter_the_nether", UUID(uuid))
+                    e = m.earliest("story.enter_the_nether", uuid)
                     if e is not None:
                         p.dynamic["nether_entries"].append(e.time)
 
@@ -0,0 +1,68 @@
+"""
+For each player, the positions of the matches they played in, in one root
+index. Lets `filter uuid(x)` & co. go straight to a player's matches instead
+of looking at every match in the index.
+
+Positions only ever get appended (live matches are added to the end of an
+index, see Dataset.updated), so every version of an index shares one Postings.
+A version only looks at the positions that are inside of it.
+
+Some corrupted matches have a winner that isn't one of their members, so
+they're kept aside as strays: `filter winner(x)` has to look at those too.
+"""
+from array import array
+from bisect import bisect_left
+
+from .match import QueryMatch
+from .store import PLAYERS
+
+
+class Postings:
+    def __init__(self, l: list[QueryMatch]):
+        self.played: dict[int, array] = dict()
+        # Positions of the matches whose winner is a player, but not one of their members.
+        self.strays = array("I")
+        # How many positions have been added.
+        self.size = 0
+        self.add(l, 0)
+
+    def add(self, l: list[QueryMatch], start: int):
+        # l are the matches at positions start, start + 1...
+        played = self.played
+        if start < self.size:
+            # Left over from an update that never got published (it failed part way), so
+            # nobody can be looking at them. l goes there instead.
+            for positions in played.values():
+                del positions[bisect_left(positions, start) :]
+            del self.strays[bisect_left(self.strays, start) :]
+        self.size = start + len(l)
+        # Draws and decays aren't won by anyone, so no player filter wants them.
+        nobody = {PLAYERS.ids.get("__draw"), PLAYERS.ids.get("__decay")}
+        for i, m in enumerate(l, start):
+            winner = m.winner_pid
+            stray = winner not in nobody
+            for mem in m.members:
+                positions = played.get(mem.pid)
+                if positions is None:
+                    positions = played[mem.pid] = array("I")
+                positions.append(i)
+                if mem.pid == winner:
+                    stray = False
+            if stray:
+                self.strays.append(i)
+
+    def positions(self, uuid: str, size: int):
+        # Positions (below size) of the matches uuid played in.
+        positions = self.played.get(PLAYERS.ids.get(uuid), ())
+        return positions[: bisect_left(positions, size)]
+
+    def matches(self, l: list[QueryMatch], uuids, strays=False) -> list[QueryMatch]:
+        # The matches in l that any of uuids played in (plus the strays, if set), in the order of l.
+        if len(uuids) == 1 and not strays:
+            return [l[i] for i in self.positions(next(iter(uuids)), len(l))]
+        merged = set()
+        for uuid in uuids:
+            merged.update(self.positions(uuid, len(l)))
+        if strays:
+            merged.update(self.strays[: bisect_left(self.strays, len(l))])
+        return [l[i] for i in sorted(merged)]
@@ -0,0 +1,47 @@
+"""
+Root indexes only ever grow: live matches go on the end (see Dataset.updated).
+So every version of one shares a single list that only gets appended to, and
+just remembers how much of it is its own. A version gets a list of its own (a
+copy of that much) the first time something asks for it, instead of on every
+update, so an update costs the size of the update.
+"""
+from threading import Lock
+
+
+class Prefix:
+    def __init__(self, shared: list | None, n: int, l: list | None = None):
+        self.shared = shared
+        self.n = n
+        self._l = l
+        self.lock = Lock()
+
+    @staticmethod
+    def of(l: list) -> "Prefix":
+        # l as it is. Nothing shares it until it's grown.
+        return Prefix(None, len(l), l)
+
+    @property
+    def l(self) -> list:
+        l = self._l
+        if l is None:
+            # Once, so everyone gets the same list.
+            with self.lock:
+                if self._l is None:
+                    self._l = self.shared[: self.n]
+                l = self._l
+        return l
+
+    def grown(self, other: list) -> "Prefix":
+        """
+        The next version, with other on the end. Only the newest version is
+        ever grown: anything in shared past n is from an update that never got
+        published, so nobody is looking at it.
+        """
+        shared = self.shared
+        if shared is None:
+            # The first update copies. After that it's only appends.
+            shared = self.shared = list(self._l)
+        elif len(shared) > self.n:
+            del shared[self.n :]
+        shared.extend(other)
+        return Prefix(shared, len(shared))
@@ -1,13 +1,17 @@
 from collections import defaultdict
 from .extra_types import UUID, Milliseconds, Seconds, is_numeric
-from .match import QueryMatch
+from .match import MatchMember, QueryMatch, Timeline, UUIDList
 from.parse_utils import partition_list
 from .component import Component
 from .expression import Expression
-from .dataset import SUPPORTED_ITERABLES, Dataset, UUIDDataset, format_str
-from typing import Callable, Any
+from .dataset import SUPPORTED_ITERABLES, AsMostDatalist, Dataset, Selection, Stream, UUIDDataset, format_str, get_partitions
+from .bitmaps import BITMAP_ATTRIBUTES
+from heapq import nlargest, nsmallest
+from itertools import islice
+from operator import attrgetter, itemgetter, methodcaller
+from typing import Callable, Any, Iterator
 from . import commands, jobs, splits
-from .players import MatchPlayer, PlayerManager
+from .players import MatchPlayer, Player, PlayerManager
 from .parse import parse_boolean
 from .utils import average, median, time_fmt, Percentage
 from .strings import HELP, CHANGELOG, EXAMPLES
@@ -22,10 +26,74 @@ def is_extract_failure(val):
         return val == mef or val == pef
     return False
 
+# Types whose extract(k, *args) is _extract(self, k, *args) whenever that finds k,
+# and whether they pass args on to rql_ functions.
+DIRECT_EXTRACT = {QueryMatch: True, MatchMember: True, Timeline: False, Player: False}
+
+# (type, attribute, args) -> its getter, or None if every object has to be asked. See DirectExtractor.
+EXTRACTORS: dict[tuple, Callable | None] = dict()
+
+
+def DirectExtractor(ex, v: str, args=()) -> Callable | None:
+    """
+    A getter doing what o.extract(v, *args) does for any o of ex's type, as a single
+    attribute access (or rql_ call) instead of going through extract every time.
+    Worked out once per type & attribute.
+    """
+    key = (type(ex), v, tuple(args))
+    if key not in EXTRACTORS:
+        EXTRACTORS[key] = _direct_getter(ex, v, tuple(args))
+    return EXTRACTORS[key]
+
+
+def _direct_getter(ex, v: str, args: tuple):
+    t = type(ex)
+    if t not in DIRECT_EXTRACT or v.startswith("_") or (args and not DIRECT_EXTRACT[t]):
+        return None
+
+    def declared(name):
+        return any([name in c.__dict__ for c in t.__mro__]) or name in getattr(ex, "__dict__", ())
+
+    if declared(v):
+        return attrgetter(v)
+    if declared("rql_" + v):
+        return methodcaller("rql_" + v, *args)
+    # e.g. QueryMatch asks its members & timelines next.
+    return None
+
+
 def BasicExtractor(ex, v):
+    # Creates and returns a smart extractor for ex
+    try:
+        return ProbingExtractor(ex, v)
+    except RuntimeError:
+        if not isinstance(v, str) or "." not in v.strip("."):
+            raise
+    # A path like members.elo: each attribute is extracted from what the one before gave.
+    return PathExtractor(ex, v.split("."))
+
+
+def PathExtractor(ex, path: list[str]):
+    getters = list()
+    for attribute in path:
+        if ex is None:
+            raise RuntimeError(f"Could not extract {attribute} (of {'.'.join(path)}) from None.")
+        getter, ex = BasicExtractor(ex, attribute)
+        getters.append(getter)
+
+    def getter(o):
+        for g in getters:
+            if o is None:
+                return None
+            o = g(o)
+        return o
+
+    return getter, ex
+
+
+def ProbingExtractor(ex, v):
     from .match import ExtractFailure as mef
     from .players import ExtractFailure as pef
-    # Creates and returns a smart extractor for ex
 
     # v can be a list of arguments to a function.
     # in that case it will be a tuple.
@@ -36,6 +104,10 @@ def BasicExtractor(ex, v):
     else:
         args = []
 
+    getter = DirectExtractor(ex, v, args)
+    if getter is not None:
+        return getter, getter(ex)
+
     # Does it have .extract()?
     try:
         example = ex.extract(v, *args)
@@ -227,6 +299,78 @@ def SmartReplacer(ex, a):
     raise RuntimeError(f"Could not find a way to extract {a} from {type(ex)}. Try | attrs.")
 
 
+# Commands whose result only depends on their input and arguments (plus the
+# warnings they add), so running the same ones again after an `index` gives
+# the same result. See shared_prefixes. Not `players`: it makes new objects
+# that later commands change (applymappeddata, enumerate), so every part needs its own.
+PURE_COMMANDS = {
+    "index", "filter", "extract", "to_timelines", "segmentby", "sort", "rsort", "take",
+    "drop", "dropn", "between", "require", "flatten", "splits.get_if", "splits.diff",
+}
+
+
+def expression_key(e: Expression):
+    return (e.command, repr(e.arguments))
+
+
+def shared_prefixes(keys: list[tuple]) -> set[int]:
+    """
+    Queries like the bot's quicklook start over with `index ...` again and again,
+    repeating the first few commands every time. Returns the positions whose
+    result (from their `index` up to them) will be needed again later on.
+    """
+    starts = [i for i, k in enumerate(keys) if k[0] == "index"]
+    pure = dict()
+    for start in starts:
+        n = 1
+        while start + n < len(keys) and keys[start + n][0] in PURE_COMMANDS and keys[start + n][0] != "index":
+            n += 1
+        pure[start] = n
+    res = set()
+    for j, b in enumerate(starts):
+        for a in starts[:j]:
+            n = 0
+            while n < min(pure[a], pure[b]) and keys[a + n] == keys[b + n]:
+                n += 1
+            if n > 0:
+                res.add(a + n - 1)
+    return res
+
+
+# Match attributes that are players, and whether they can be a player that isn't one
+# of its members (corrupted matches have such winners). Filters on these can start
+# from the player's postings, plus the strays if need be (see postings.py).
+PLAYER_ATTRIBUTES = {"uuid": False, "uuids": False, "members": False, "loser": False, "winner": True}
+
+
+# Streaming commands whose results are some of their input, in the same order.
+PICKING_COMMANDS = {"filter", "drop", "between", "require", "take", "dropn"}
+
+# Commands that can work from a Selection (positions in a root index) without the matches.
+SELECTION_COMMANDS = {"count", "sort", "rsort"}
+
+
+def sorted_take(e: Expression, after: Expression):
+    """
+    `sort x | take [last] n` (or rsort) -> (x, n, last, reverse), which topsorted
+    does without sorting everything. None if it's anything else.
+    """
+    if e.command not in ("sort", "rsort") or after.command != "take":
+        return None
+    if len(e.arguments) != 1 or not all([type(a) is str for a in e.arguments + after.arguments]):
+        return None
+    ints, sa = partition_list(list(after.arguments), lambda a: a.isdigit())
+    # take 0 & take last 0 aren't worth it (and aren't the same thing), take without n gives one item.
+    if len(ints) != 1 or int(ints[0]) == 0:
+        return None
+    return e.arguments[0], int(ints[0]), "last" in sa, e.command == "rsort"
+
+
+class StageError(RuntimeError):
+    # Already says which command it came from.
+    pass
+
+
 class Runtime(Component):
     def __init__(self, datasets: dict[str, Dataset], commands: dict[str, Callable], formatter=None):
         super().__init__("Runtime")
@@ -395,11 +539,17 @@ class Runtime(Component):
 
             e = SmartExtractor(d.example(), attr)
             example = e(d.example())
+            l = d.l
+            if d.postings is not None and type(d.example()) is QueryMatch:
+                inner = example[0] if isinstance(example, list) and example else example
+                if type(inner) is UUID and attr in PLAYER_ATTRIBUTES and not s & {"__draw", "__decay"}:
+                    # Only look at the matches of the players in variable.
+                    l = d.postings.matches(l, s, PLAYER_ATTRIBUTES[attr])
             if isinstance(example, list):
                 # Quick fix for now.
-                return [o for o in d.l if any([inner in s for inner in e(o)])]
+                return [o for o in l if any([inner in s for inner in e(o)])]
 
-            res = [x for x in d.l if e(x) in s]
+            res = [x for x in l if e(x) in s]
             if not res:
                 self.add_result(f"Warning: During keepifattrcontained({attr}, {str}), the resulting dataset was empty.")
             return res
@@ -428,9 +578,28 @@ class Runtime(Component):
             Usage example: `index all | filter completed | sort duration | take 5` - top 5 completions of all time.
             """
             self.log(f"Changing dataset to {name}")
+            partitions = get_partitions()
             if name.startswith("s") and name[1:].isdecimal():
+                season = int(name[1:])
+                if partitions is not None and season in partitions:
+                    # Old season, kept on disk. Same as below, once it's loaded.
+                    res = self.datasets["most"].clone(partitions.with_season(season, self.datasets["all"].l, AsMostDatalist))
+                    # Shared by every query until the partition or all changes, like a root index.
+                    res.root = True
+                    return res
+                idx = self.datasets["most"].season_index(season)
+                if idx is not None:
+                    return idx
+                # No matches from it. This says so.
                 return localfilter(localindex(None, "most"), ("season", name.lstrip("s")))
             if name == "all":
+                if partitions is not None and partitions.seasons:
+                    self.add_result(
+                        f"*Warning: Dataset `all` contains* ***all*** *matches, including decay matches, unranked matches, and cheated matches. `index most` only contains legitimate, ranked, non-decay matches.* *Older seasons are loaded from disk when needed, which can take a while.*"
+                    )
+                    res = self.datasets["all"].clone(partitions.with_all(self.datasets["all"].l))
+                    res.root = True
+                    return res
                 self.add_result(
                     f"*Warning: Dataset `all` contains* ***all*** *matches, including decay matches, unranked matches, and cheated matches. `index most` only contains legitimate, ranked, non-decay matches.* **No datasets contain moderately old matches due to RAM limitations. See `index all | extract season | count_uniques`.**"
                 )
@@ -558,14 +727,31 @@ class Runtime(Component):
                 return
             self.add_result(self.format(com.help, "doc"))
 
+        def sort_orders(d: Dataset):
+            # Kept sorts of d, if it's a root index, else of the all index (everything else is part of it).
+            if d.orders is not None:
+                return d.orders
+            return self.datasets["all"].orders if "all" in self.datasets else None
+
         @Local()
         def localsort(d: Dataset, attribute, **kwargs):
             """
             `sort(attribute)` - Sorts the dataset based on `attribute`. To list attributes, see `help attrs`
             """
             # For now this should do the trick.
+            if isinstance(d, Selection):
+                res = d.source.orders.sorted_positions(d.positions, attribute, kwargs.get("reverse", False))
+                if res is not None:
+                    self.log(f"Sorted on {attribute} using a kept order.")
+                    return res
             if not d.l:
                 return list()
+            orders = sort_orders(d)
+            if orders is not None and type(d.l) is list:
+                res = orders.sorted(d.l, attribute, kwargs.get("reverse", False))
+                if res is not None:
+                    self.log(f"Sorted on {attribute} using a kept order.")
+                    return res
             extractor = SmartExtractor(d.l[0], attribute)
             res = [x for x in d.l if extractor(x) is not None]
             lb = len(d.l)
@@ -574,7 +760,42 @@ class Runtime(Component):
                 self.notes.append(
                     f"Warning: During sort on {attribute}, {lb - la} " "items were dropped, as their value was None."
                 )
-            return sorted(res, key=lambda x: extractor(x), **kwargs)
+            return sorted(res, key=extractor, **kwargs)
+
+        def topsorted(d: Dataset, attribute, n: int, last: bool, reverse: bool):
+            # localsort then take [last] n, ties and all, in one pass over d.
+            if not len(d):
+                return list()
+            if d.orders is not None and d.orders.l is d.l:
+                res = d.orders.top(attribute, n, last, reverse)
+                if res is not None:
+                    return res
+            if isinstance(d, Selection) and d.positions:
+                res = d.source.orders.top(attribute, n, last, reverse, d.positions)
+                if res is not None:
+                    return res
+            extractor = SmartExtractor(d.l[0], attribute)
+            dropped = 0
+
+            def keyed():
+                # Nothing is kept around for items that don't make it.
+                nonlocal dropped
+                for x in reversed(d.l) if last else d.l:
+                    k = extractor(x)
+                    if k is None:
+                        dropped += 1
+                    else:
+                        yield k, x
+
+            # heapq's are the same as sorted(...)[:n]. The last n of a sort are the first n
+            # of the opposite sort of the reversed list, reversed.
+            pick = nsmallest if reverse == last else nlargest
+            res = [x for _, x in pick(n, keyed(), key=itemgetter(0))]
+            if dropped:
+                self.notes.append(
+                    f"Warning: During sort on {attribute}, {dropped} " "items were dropped, as their value was None."
+                )
+            return res[::-1] if last else res
 
         @Local()
         def localraw(d: Dataset, *attributes):
@@ -688,6 +909,13 @@ class Runtime(Component):
                 return data[-1 * n :]
             return data[:n]
 
+        @localtake.streamer
+        def streamtake(s: Stream, *args):
+            ints, sa = partition_list(list(args), lambda a: a.isdigit())
+            if len(ints) != 1 or "last" in sa or int(ints[0]) == 0:
+                return None
+            return islice(s.rest(), int(ints[0]))
+
         @Local()
         def localslice(l: Dataset, *args):
             """
@@ -769,7 +997,9 @@ class Runtime(Component):
             `count` - Returns the current dataset size.
             """
             tg = "" if not tag else f"({tag}) "
-            if type(l.l) is list:
+            if isinstance(l, Selection):
+                self.add_result(f"{tg}Current size: {len(l)}")
+            elif type(l.l) is list:
                 self.add_result(f"{tg}Current size: {len(l.l)}")
             else:
                 self.add_result(f"{tg}Dataset currently only has one item.")
@@ -784,12 +1014,20 @@ class Runtime(Component):
             If more than one attribute is supplied, extracts all attributes into a tuple.
             """
 
+            extractor = extractfunction(l, *args)
+            return [extractor(x) for x in l.l]
+
+        @localextract.streamer
+        def streamextract(s: Stream, *args):
+            extractor = extractfunction(s, *args)
+            yield from map(extractor, s.rest())
+
+        def extractfunction(l: Dataset | Stream, *args):
             # If there's only one thing
             if len(args) == 1:
-                extractor = SmarterExtractor(l.example(), *args)
-                return [extractor(x) for x in l.l]
+                return SmarterExtractor(l.example(), *args)
             extractors = [SmarterExtractor(l.example(), a) for a in args]
-            return [tuple(e(x) for e in extractors) for x in l.l]
+            return lambda x: tuple(e(x) for e in extractors)
 
         @Local()
         def localto_timelines(l: Dataset):
@@ -868,6 +1106,15 @@ class Runtime(Component):
             Note: This is a stopgap solution as proper expression parsing is not implemented yet for
             filter expressions. In the future, this will just be `filter attribute<4` or similar.
             """
+            keep = betweenfunction(d, attribute, min_val, max_val)
+            return [x for x in d.l if keep(x)]
+
+        @localbetween.streamer
+        def streambetween(s: Stream, attribute, min_val, max_val):
+            keep = betweenfunction(s, attribute, min_val, max_val)
+            yield from filter(keep, s.rest())
+
+        def betweenfunction(d: Dataset | Stream, attribute, min_val, max_val):
             l = float(min_val)
             u = float(max_val)
             extractor = SmartExtractor(d.example(), attribute)
@@ -878,9 +1125,11 @@ class Runtime(Component):
                 v = float(v)
                 return v >= l and v <= u
 
-            return [x for x in d.l if is_between(extractor(x))]
+            return lambda x: is_between(extractor(x))
 
         def getslots(e: Any):
+            if isinstance(e, (QueryMatch, MatchMember)):
+                return e.attributes
             if hasattr(e, "__slots__"):
                 return e.__slots__
             return [x for x in dir(e) if not x.startswith("_")]
@@ -945,6 +1194,11 @@ class Runtime(Component):
             e = SmartExtractor(d.example(), attr)
             return d.clone([x for x in d.l if e(x) is not None])
 
+        @localrequire.streamer
+        def streamrequire(s: Stream, attr: str):
+            e = SmartExtractor(s.example(), attr)
+            yield from (x for x in s.rest() if e(x) is not None)
+
         @Local()
         def localdrop_outliers(d: Dataset, attr: str, factor: str = "4", method="diff"):
             """
@@ -1007,6 +1261,15 @@ class Runtime(Component):
             This is also a temporary solution for filter not being powerful enough.
             Later, it will be possible to just do `filter winner(not(desktopfolder))`
             """
+            keep = dropfunction(d, attribute, value)
+            return [x for x in d.l if keep(x)]
+
+        @localdrop.streamer
+        def streamdrop(s: Stream, attribute, value):
+            keep = dropfunction(s, attribute, value)
+            yield from filter(keep, s.rest())
+
+        def dropfunction(d: Dataset | Stream, attribute, value):
             extractor, t = AutoExtractor(d, attribute, no_none=False)
             if t() is None:
                 raise RuntimeError(f'All values for {attribute} are `None` in | drop {attribute} {value}')
@@ -1023,20 +1286,18 @@ class Runtime(Component):
                 if value[0] == "None":
                     value = None
                 elif value[0] == "lt":
-                    return [x for x in d.l if extractor(x) >= value[1]]
+                    return lambda x: extractor(x) >= value[1]
                 elif value[0] == "gt":
-                    return [x for x in d.l if extractor(x) <= value[1]]
+                    return lambda x: extractor(x) <= value[1]
                 elif value[0] == "anylt":
                     a, b = attribute.split(".")
-                    return [x for x in d.l if all([y.extract(b) >= value[1] for y in extractor(x)])]
+                    return lambda x: all([y.extract(b) >= value[1] for y in extractor(x)])
                 elif value[0] == "test_winner_lower":
                     # lol, ok, whatever, language dev later sometime ig
-                    return [
-                        m
-                        for m in d.l
-                        if type(m) == QueryMatch and not m.rql_is_draw() and (m.rql_loser().elo > m.rql_winner().elo)
-                    ]
-            return [x for x in d.l if extractor(x) != value]
+                    return lambda m: (
+                        type(m) == QueryMatch and not m.rql_is_draw() and (m.rql_loser().elo > m.rql_winner().elo)
+                    )
+            return lambda x: extractor(x) != value
 
         @Local()
         def localtest_list(d: Dataset, attribute, operation, destination=None):
@@ -1111,70 +1372,154 @@ class Runtime(Component):
             may also use the simplified filter syntax: `filter noabnormal nodecay ff` is the
             equivalent of `filter is_abnormal(false) is_decay(false) is_ff(true)`
             """
-            res: list[Any] = l.l
-            for filt in args:
+            res, start = bitmapfilter(l, args)
+            for filt in args[start:]:
                 # Short circuit if we have no objects.
                 if not res:
                     self.log(f"Avoided applying filter {filt} and any additional filters (empty result).")
                     break
 
-                # For now, support a bunch of nice boolean autodetection/conversions.
-                if type(filt) == str:
-                    prefilt = filt
-                    b = True
-                    if filt.startswith("no"):
-                        b = False
-                        filt = filt[2:]
-                    filt = (f"is_{filt}", b)
-                    self.log(f"Found simple boolean filter {prefilt} and converted it to {filt}.")
-
-                if type(filt) == tuple:
-                    # Let's be smart about this. Get our desired destination type for conversion.
-                    # Is that smart? Whatever, this is a query language built in Python, anyways.
-                    first = res[0]
-                    # varname(desired)
-                    # e.g. player(john)
-                    varname, desired = filt
-                    example = first.extract(varname)
-
-                    def filter_function(li: Any) -> bool:
-                        return li.extract(varname) == desired
-
-                    if type(example) is list:
-                        if len(example):
-                            example = example[0]
-
-                        def filter_function(li: Any) -> bool:
-                            return desired in li.extract(varname)
-
-                    if type(example) is bool:
-                        desired = parse_boolean(desired)
-                    elif type(example) is UUID:
-                        try:
-                            desired = self.user_dataset.convert_user(desired)
-                        except KeyError:
-                            self.notes.append(f"{desired} is not a known username.")
-                            desired = None
-                    elif type(example) is int:
-                        desired = int(desired)
-                    # elif callable(example):
-                    #    def filter_function(li: Any) -> bool:
-                    #        return li.extract(varname)(desired)
-
-                    preres = len(res)
-                    res = [m for m in res if filter_function(m)]
-                    self.log(f"Applied filter {filt} and got {len(res)} resulting objects (from {preres}).")
-                    if not res:
-                        self.add_result(f"Note: The filter {filt} matched 0 results, which might indicate an error.")
-                        #raise RuntimeError(
-                        #    f"Empty dataset after applying filter: {filt}. This can indicate the wrong attribute is being filtered on, or that the value being searched for is wrong, or just that there are no results that match your query."
-                        #)
-                        # return l.clone(f'Empty dataset after applying filter: {filt}')
-                else:
-                    raise RuntimeError(f"Unsupported filter type {type(filt)} for filter {filt}")
+                filt, filter_function, player, _ = filterfunction(filt, res[0])
+                preres = len(res)
+                if player is not None and res is l.l and l.postings is not None:
+                    # Only look at that player's matches.
+                    res = l.postings.matches(res, [player], PLAYER_ATTRIBUTES[filt[0]])
+                res = [m for m in res if filter_function(m)]
+                self.log(f"Applied filter {filt} and got {len(res)} resulting objects (from {preres}).")
+                if not res:
+                    self.add_result(f"Note: The filter {filt} matched 0 results, which might indicate an error.")
+                    #raise RuntimeError(
+                    #    f"Empty dataset after applying filter: {filt}. This can indicate the wrong attribute is being filtered on, or that the value being searched for is wrong, or just that there are no results that match your query."
+                    #)
+                    # return l.clone(f'Empty dataset after applying filter: {filt}')
 
             return res
 
+        @localfilter.streamer
+        def streamfilter(s: Stream, *args):
+            # One stage per filter argument, each set up from the first object that reaches it.
+            def stage(s: Stream, filt):
+                found, first = s.first()
+                if not found:
+                    self.log(f"Avoided applying filter {filt} (empty result).")
+                    return
+                filt, filter_function, player, _ = filterfunction(filt, first)
+                src = s.rest()
+                if player is not None and s.dataset is not None and s.dataset.postings is not None:
+                    src = iter(s.dataset.postings.matches(s.dataset.l, [player], PLAYER_ATTRIBUTES[filt[0]]))
+                n = 0
+                for m in src:
+                    if filter_function(m):
+                        n += 1
+                        yield m
+                self.log(f"Applied filter {filt} and got {n} resulting objects.")
+                if not n:
+                    self.add_result(f"Note: The filter {filt} matched 0 results, which might indicate an error.")
+
+            def bitmapped(s: Stream):
+                res, n = bitmapfilter(s.dataset, args)
+                if n:
+                    s = Stream(iter(res))
+                for filt in args[n:]:
+                    s = Stream(stage(s, filt))
+                yield from s.rest()
+
+            if s.dataset is not None and s.dataset.bitmaps is not None:
+                return bitmapped(s)
+            for filt in args:
+                s = Stream(stage(s, filt))
+            return s.rest()
+
+        def filterfunction(filt, first):
+            # Also returns the player filtered on (uuid), if the matching objects must have that player as a member.
+            # For now, support a bunch of nice boolean autodetection/conversions.
+            if type(filt) == str:
+                prefilt = filt
+                b = True
+                if filt.startswith("no"):
+                    b = False
+                    filt = filt[2:]
+                filt = (f"is_{filt}", b)
+                self.log(f"Found simple boolean filter {prefilt} and converted it to {filt}.")
+
+            if type(filt) != tuple:
+                raise RuntimeError(f"Unsupported filter type {type(filt)} for filter {filt}")
+
+            # Let's be smart about this. Get our desired destination type for conversion.
+            # Is that smart? Whatever, this is a query language built in Python, anyways.
+            # varname(desired)
+            # e.g. player(john)
+            varname, desired = filt
+            get = DirectExtractor(first, varname) or methodcaller("extract", varname)
+            example = get(first)
+
+            def filter_function(li: Any) -> bool:
+                return get(li) == desired
+
+            equality = True
+            if type(example) is list:
+                if len(example):
+                    example = example[0]
+
+                def filter_function(li: Any) -> bool:
+                    return desired in get(li)
+
+                equality = False
+            elif type(example) is UUIDList:
+                example = UUID()
+
+                def filter_function(li: Any) -> bool:
+                    return get(li).get(desired) is not None
+
+                equality = False
+            if type(example) is bool:
+                desired = parse_boolean(desired)
+            elif type(example) is UUID:
+                try:
+                    desired = self.user_dataset.convert_user(desired)
+                except KeyError:
+                    self.notes.append(f"{desired} is not a known username.")
+                    desired = None
+            elif type(example) is int:
+                desired = int(desired)
+            # elif callable(example):
+            #    def filter_function(li: Any) -> bool:
+            #        return li.extract(varname)(desired)
+            player = None
+            if type(example) is UUID and type(first) is QueryMatch and varname in PLAYER_ATTRIBUTES and desired not in ("__draw", "__decay"):
+                player = desired
+            # What a bitmap would need to answer it, see bitmapfilter.
+            equals = (varname, desired, get) if equality else None
+            return filt, filter_function, player, equals
+
+        def bitmapfilter(d: Dataset, args) -> tuple[list, int]:
+            # Applies the filters at the start of args that d's bitmaps can answer.
+            # Returns what's left and how many filters that was.
+            if d.bitmaps is None or not d.l:
+                return d.l, 0
+            bits, n = None, 0
+            for filt in args:
+                # Without setting it up, as that can add notes (e.g. unknown users).
+                varname = f"is_{filt.removeprefix('no')}" if type(filt) is str else filt[0] if type(filt) is tuple else None
+                if varname not in BITMAP_ATTRIBUTES:
+                    break
+                # Set up from the first match left, same as filtering row by row.
+                first = d.l[0] if bits is None else d.l[(bits & -bits).bit_length() - 1]
+                filt, _, _, equals = filterfunction(filt, first)
+                found = None if equals is None else d.bitmaps.bits(*equals)
+                if found is None:
+                    break
+                bits = found if bits is None else bits & found
+                n += 1
+                count = bits.bit_count()
+                self.log(f"Applied filter {filt} and got {count} resulting objects (from bitmaps).")
+                if not count:
+                    self.add_result(f"Note: The filter {filt} matched 0 results, which might indicate an error.")
+                    break
+            if bits is None:
+                return d.l, 0
+            return d.bitmaps.matches(bits), n
+
         @Local()
         def localjob(l, job: tuple[str, str]):
             """
@@ -1204,25 +1549,111 @@ class Runtime(Component):
                 return execute_simple(e.command, e.arguments)
             raise RuntimeError(f"Could not execute: {e}")
 
+        def describe(e: Expression, err: Exception):
+            return f'While executing `{e.command} {" ".join([str(x) for x in e.arguments])}`, encountered error of type {type(err)}: {err}'
+
+        def guarded(it: Iterator, e: Expression):
+            # Errors in a streaming command only happen once something pulls on it.
+            try:
+                yield from it
+            except StageError:
+                raise
+            except Exception as err:
+                raise StageError(describe(e, err)) from err
+
+        # Results of streaming commands that nothing has needed a list of yet.
+        pending: Iterator | None = None
+        # The root index pending is picking matches out of, if that's all it does.
+        picking_from: Dataset | None = None
+
+        # Results that a later `index ...` part of the query starts the same way as.
+        # key -> (dataset, results added while getting it, notes added while getting it)
+        keys = [expression_key(e) for e in pipeline]
+        saves = shared_prefixes(keys)
+        prefixes: dict[tuple, tuple[Dataset, list, list]] = dict()
+        start, marks = 0, (0, 0)
+
+        def reuse(pos: int):
+            # Longest saved result this part starts with. Always leaves the last command to run.
+            for n in range(len(pipeline), 0, -1):
+                saved = prefixes.get(tuple(keys[pos : pos + n]))
+                if saved is not None:
+                    return n, saved
+            return 0, None
+
+        pos = -1
         while pipeline:
             e = pipeline.pop(0)
+            pos += 1
             eid = f"Expression@c:{e.loc}"
             self.time(eid)
             try:
-                exe = try_execute(e)
-                res = exe(dataset)
+                if e.command == "index":
+                    if pending is not None:
+                        dataset = dataset.clone(list(pending))
+                        pending = None
+                    start, marks = pos, (len(self._result or ()), len(self.notes))
+                    n, saved = reuse(pos)
+                    if saved is not None:
+                        self.log(f"Reusing the result of the first {n} commands of an earlier part of the query.")
+                        dataset, results, notes = saved
+                        if results:
+                            self._result = (self._result or list()) + results
+                        self.notes.extend(notes)
+                        # Later commands never change a list in place, but the saved one is shared, so be sure.
+                        if type(dataset.l) is list and not dataset.root and not any([dataset is d for d in self.datasets.values()]):
+                            dataset = dataset.clone(list(dataset.l))
+                        del pipeline[: n - 1]
+                        pos += n - 1
+                        self.log_time(eid)
+                        continue
+                fused = sorted_take(e, pipeline[0]) if pipeline and pos not in saves else None
+                if fused is not None:
+                    self.log(f"Taking the top {fused[1]} of {e.command} {fused[0]} without sorting everything.")
+                    pipeline.pop(0)
+                    pos += 1
+                    exe = commands.Executor(lambda d: topsorted(d, *fused)).prime()
+                else:
+                    exe = try_execute(e)
+                it = None
+                if pending is not None or type(dataset.l) is list:
+                    it = exe.stream(Stream(iter(dataset.l), dataset) if pending is None else Stream(pending))
+                if it is not None:
+                    if pending is None:
+                        picking_from = dataset.source if isinstance(dataset, Selection) else dataset
+                    if picking_from is not None and (picking_from.orders is None or e.command not in PICKING_COMMANDS):
+                        picking_from = None
+                    pending = guarded(it, e)
+                    res = None
+                else:
+                    if pending is not None:
+                        if picking_from is not None and e.command in SELECTION_COMMANDS:
+                            # Only the positions of what the filters kept.
+                            dataset = Selection(picking_from, picking_from.orders.positions(pending))
+                        else:
+                            dataset = dataset.clone(list(pending))
+                        pending = None
+                    res = exe(dataset)
                 # TODO - rolling 'latest dataset metainfo' here for games
                 if res is None:
                     pass
                 elif type(res) in SUPPORTED_ITERABLES:
                     dataset = dataset.clone(res)
                 else:
-                    if not type(res) == Dataset:
+                    if not isinstance(res, Dataset):
                         raise RuntimeError(f"Got unhandled result type {type(res)} in {e}")
                     dataset = res
+                if pending is not None and (not pipeline or pos in saves):
+                    dataset = dataset.clone(list(pending))
+                    pending = None
+                if pos in saves:
+                    results = [] if self._result is None else self._result[marks[0] :]
+                    prefixes[tuple(keys[start : pos + 1])] = (dataset, results, self.notes[marks[1] :])
                 self.log_time(eid)
+            except StageError as err:
+                raise RuntimeError(str(err)) from err.__cause__
             except Exception as err:
-                raise RuntimeError(f'While executing `{e.command} {" ".join([str(x) for x in e.arguments])}`, encountered error of type {type(err)}: {err}') from err
+                raise RuntimeError(describe(e, err)) from err
 
             if not pipeline:
                 # Determine if this is terminal.
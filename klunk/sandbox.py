@@ -1,6 +1,83 @@
+from collections import OrderedDict
+
 from .language import *
 from .runtime import Runtime
-from .dataset import load_defaults
+from .commands import UNCACHEABLE
+from .dataset import Dataset, Selection, current_version, load_defaults
+
+# Roughly how many items (result entries + result lines) the cache may hold.
+RESULT_CACHE_BUDGET = 1_000_000
+
+
+class ResultCache:
+    """
+    The results of recent queries against the current dataset version, least
+    recently used first. A new version (live matches arriving) empties it.
+
+    The budget is in items (result lines + matches/values in the result), like
+    the partition cache's, not bytes: the items are shared with the datasets,
+    so what an entry costs is mostly how many there are. Keys aren't folded to
+    one case either, as command names and some arguments are case sensitive.
+    Queries that only differ in case just get an entry each.
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.version = None
+        self.entries: OrderedDict[str, tuple[Runtime, Dataset | None, int]] = OrderedDict()
+        # Sum of the entries' sizes.
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+
+    def size(self) -> int:
+        return self.used
+
+    def check_version(self, version: int):
+        if version != self.version:
+            self.entries.clear()
+            self.used = 0
+            self.version = version
+
+    def get(self, key: str, version: int):
+        self.check_version(version)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, version: int, runtime: Runtime, result: Dataset | None):
+        self.check_version(version)
+        size = len(runtime._result or ()) + 1
+        if isinstance(result, Selection):
+            size += len(result)
+        elif result is not None and hasattr(result.l, "__len__"):
+            size += len(result.l)
+        if size > self.budget:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.used -= old[2]
+        self.entries[key] = (runtime, result, size)
+        self.used += size
+        while self.used > self.budget:
+            self.used -= self.entries.popitem(last=False)[1][2]
+
+    def stats(self) -> str:
+        return f"Result cache: {len(self.entries)} results ({self.size()} items), {self.hits} hits, {self.misses} misses."
+
+
+RESULT_CACHE = ResultCache(RESULT_CACHE_BUDGET)
+
+
+def cache_key(program: list[Expression], parameters: list[str]) -> str | None:
+    # The compiled program, so spacing doesn't matter. None if it can't be cached.
+    if any([e.command in UNCACHEABLE for e in program]):
+        return None
+    return repr((parameters, [(e.command, e.arguments) for e in program]))
 
 
 class Query(Component):
@@ -14,6 +91,7 @@ class Query(Component):
         self.tokenizer = Tokenizer()
         self.runtime = None
         self.formatter = formatter
+        self.version = None
 
         self.tokens = None
         self.program = None
@@ -32,8 +110,11 @@ class Query(Component):
             loc = "klunk/samples/"
 
         # Now construct the runtime, for which we need to load samples, etc.
-        datasets = load_defaults(loc, quiet=not debug, set_discord=set_discord, no_mq=self.no_mq)
-        return datasets
+        load_defaults(loc, quiet=not debug, set_discord=set_discord, no_mq=self.no_mq)
+        # The whole query runs against this version, whatever arrives meanwhile.
+        version = current_version()
+        self.version = version.number
+        return version.datasets
 
     def run(self):
         self.log(f"Running with query: {self.query}")
@@ -47,6 +128,22 @@ class Query(Component):
 
         # Now construct the runtime, for which we need to load samples, etc.
         datasets = self.get_datasets(self.debug, set_discord=self.formatter is not None)
+
+        # Debug & timing output only happens when the query actually runs.
+        key = None
+        if not self.debug and not self._timing:
+            key = cache_key(self.program, self.parameters)
+            if self.formatter is not None:
+                key = f"discord:{key}"
+        cached = None if key is None else RESULT_CACHE.get(key, self.version)
+        if cached is not None:
+            self.log("Using cached result.")
+            self.runtime, self.result, _ = cached
+            # The caller may add to this, so don't hand out the cached one.
+            self._result = None if self.runtime._result is None else list(self.runtime._result)
+            self.log_time("Full query")
+            return self.result
+
         commands = dict()
         self.runtime = Runtime(datasets, commands, formatter=self.formatter)
 
@@ -54,6 +151,10 @@ class Query(Component):
         self.result = self.runtime.execute(self.program, self.parameters)
         # This _result is our add_result calls in a list!!
         self._result = self.runtime._result
+        if key is not None:
+            RESULT_CACHE.put(key, self.version, self.runtime, self.result)
+            if self._result is not None:
+                self._result = list(self._result)
 
         self.log_time("Full query")
 
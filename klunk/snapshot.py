@@ -0,0 +1,110 @@
+"""
+Binary snapshots of the loaded match list, so that a restart doesn't have to
+re-parse every group file from JSON.
+
+Layout: MAGIC, a little-endian u32 format version, then a stream of pickles.
+The first pickle is a header dict; the rest are lists of match rows (see
+QueryMatch.to_row), ended by a None. Each chunk of rows shares one memo, so
+each distinct uuid/split string is stored once per chunk. (The memo is cleared
+between chunks, otherwise it would keep every row ever written alive.)
+
+Bump SNAPSHOT_VERSION whenever the row layout changes. Old snapshots are then
+ignored (and rewritten) instead of being misread.
+"""
+import os
+import pickle
+import struct
+
+from .match import QueryMatch
+
+SNAPSHOT_MAGIC = b"RQLSNAP\0"
+SNAPSHOT_VERSION = 3
+CHUNK_SIZE = 10000
+
+_version = struct.Struct("<I")
+
+
+class Writer:
+    """
+    Streams matches into a snapshot at path, so that they don't all have to be in memory at once.
+    The file is written next to path and moved into place by close(), so a crash
+    half way through never leaves a truncated snapshot behind.
+    """
+
+    def __init__(self, path: str, header: dict):
+        self.path = path
+        self.tmp = f"{path}.tmp"
+        self.count = 0
+        self.rows = list()
+        self.file = open(self.tmp, "wb")
+        self.file.write(SNAPSHOT_MAGIC)
+        self.file.write(_version.pack(SNAPSHOT_VERSION))
+        self.pickler = pickle.Pickler(self.file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.pickler.dump(header)
+
+    def add(self, m: QueryMatch):
+        self.rows.append(m.to_row())
+        self.count += 1
+        if len(self.rows) >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.pickler.dump(self.rows)
+            self.pickler.clear_memo()
+            self.rows = list()
+
+    def close(self):
+        self.flush()
+        self.pickler.dump(None)
+        self.file.close()
+        os.replace(self.tmp, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp)
+
+
+def write(path: str, matches: list[QueryMatch], header: dict):
+    """
+    Writes matches to path, along with header (which must be picklable).
+    """
+    writer = Writer(path, header)
+    try:
+        for m in matches:
+            writer.add(m)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+
+
+def check_version(file) -> bool:
+    if file.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+        return False
+    (version,) = _version.unpack(file.read(_version.size))
+    if version != SNAPSHOT_VERSION:
+        print(f"Ignoring snapshot with format version {version} (current: {SNAPSHOT_VERSION}).")
+        return False
+    return True
+
+
+def read(path: str) -> tuple[dict, list[QueryMatch]] | None:
+    """
+    Returns (header, matches), or None if there is no usable snapshot at path.
+    """
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, "rb") as file:
+            if not check_version(file):
+                return None
+            unpickler = pickle.Unpickler(file)
+            header = unpickler.load()
+            res: list[QueryMatch] = list()
+            while (rows := unpickler.load()) is not None:
+                res.extend([QueryMatch.from_row(row) for row in rows])
+            return header, res
+    except Exception as e:
+        print(f"Could not read snapshot {path} ({type(e)}: {e}), ignoring it.")
+        return None
@@ -0,0 +1,115 @@
+"""
+Columnar storage for the scalar fields of every loaded QueryMatch.
+
+One Python int object per id/duration/date plus a winner UUID string adds up
+to a few hundred bytes per match. Here every field is one typed array instead,
+and a QueryMatch just remembers its row (see the properties in match.py).
+Rows of collected matches are reused, so reloading doesn't grow the store.
+
+Players and timeline split ids are stored as integer ids from PLAYERS and SPLITS.
+"""
+from array import array
+from sys import intern
+from threading import RLock
+
+from .extra_types import UUID
+
+# Pseudo-players, for the winner of drawn and decayed matches.
+PID_DRAW = 0
+PID_DECAY = 1
+
+
+class InternTable:
+    """
+    Gives every distinct string a small integer id. values[id] is the one copy
+    of that string that everything refers to.
+    """
+
+    def __init__(self, make=intern):
+        self.make = make
+        self.values: list = list()
+        self.ids: dict[str, int] = dict()
+
+    def id(self, value: str) -> int:
+        i = self.ids.get(value)
+        if i is None:
+            value = self.make(value)
+            i = len(self.values)
+            self.values.append(value)
+            self.ids[value] = i
+        return i
+
+    def __len__(self):
+        return len(self.values)
+
+
+class PlayerTable(InternTable):
+    """
+    Player uuids. Members, winners and timelines store these ids, and uuids[pid]
+    is the one UUID object that all of them share.
+    """
+
+    def __init__(self):
+        super().__init__(lambda uuid: uuid if type(uuid) is UUID else UUID(uuid))
+        self.uuids: list[UUID] = self.values
+        self.id("__draw")
+        self.id("__decay")
+
+    def uuid(self, uuid: str) -> UUID:
+        return self.uuids[self.id(uuid)]
+
+
+class MatchStore:
+    def __init__(self):
+        self.id = array("q")
+        self.type = array("b")
+        self.duration = array("q")  # Milliseconds
+        self.date = array("q")  # Seconds
+        self.season = array("h")
+        self.is_ff = array("b")
+        self.is_decay = array("b")
+        self.is_abnormal = array("b")
+        self.winner = array("i")  # Player id (PLAYERS), or PID_DRAW/PID_DECAY.
+        self.seed_type = array("B")  # Index into seed_types.
+
+        self.columns = (self.id, self.type, self.duration, self.date, self.season, self.is_ff, self.is_decay,
+                        self.is_abnormal, self.winner, self.seed_type)
+        self.seed_types: list[str | None] = [None]
+        self.seed_type_codes: dict[str | None, int] = {None: 0}
+        self.free: list[int] = list()
+        # Live matches get rows on the consumer thread, queries (partitions, copies) on theirs.
+        # Reentrant, as a collected match can release its row while its thread is in alloc.
+        self.lock = RLock()
+
+    def alloc(self) -> int:
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+            for column in self.columns:
+                column.append(0)
+            return len(self.id) - 1
+
+    def release(self, row: int):
+        with self.lock:
+            self.free.append(row)
+
+    def seed_type_code(self, seed_type: str | None) -> int:
+        code = self.seed_type_codes.get(seed_type)
+        if code is None:
+            code = len(self.seed_types)
+            if code > 255:
+                raise RuntimeError(f"Too many seed types to store {seed_type} (have: {self.seed_types[1:]})")
+            self.seed_types.append(seed_type)
+            self.seed_type_codes[seed_type] = code
+        return code
+
+    def __len__(self):
+        return len(self.id) - len(self.free)
+
+    def nbytes(self) -> int:
+        return sum([c.itemsize * len(c) for c in self.columns])
+
+
+STORE = MatchStore()
+PLAYERS = PlayerTable()
+SPLITS = InternTable()
@@ -2,11 +2,18 @@ from .language import *
 from .dataset import Dataset
 from .runtime import Runtime
 from .sandbox import Query
+from . import dataset
 
 import sys
+import tempfile
+from functools import wraps
 
 ARGS = set(sys.argv[1:])
 
+# Queries load the samples; their snapshot, journal and partitions don't belong next to them.
+CACHE = tempfile.TemporaryDirectory(prefix="rql-test-")
+dataset.CACHE_DIR = f"{CACHE.name}/"
+
 
 def ASSERT_EQ(a, b):
     if not a == b:
@@ -69,6 +76,7 @@ test_registry = list()
 
 
 def Test(f):
+    @wraps(f)
     def _test():
         f()
         print(f"All assertions passed ({f.__name__})")
@@ -77,6 +85,28 @@ def Test(f):
     return _test
 
 
+def sample_matches():
+    from .dataset import load_raw_matches
+
+    return load_raw_matches("klunk/samples/", quiet=True)
+
+
+def root_datasets(l, keep=lambda d: d):
+    # The root indexes of l, like load_defaults makes them. keep adds postings/orders/bitmaps.
+    from .dataset import ROOT_INDEXES, GetUserMappings, build_indexes
+
+    datasets = {name: keep(Dataset(name, idx, root=True)) for name, idx in build_indexes(ROOT_INDEXES, l, l[-1].season).items()}
+    uuids, users = GetUserMappings(l)
+    datasets["__uuids"], datasets["__users"] = Dataset("UUIDs", uuids, root=True), Dataset("Users", users, root=True)
+    return datasets
+
+
+def run_query(datasets, s):
+    # (result, runtime) of running s straight on datasets, without the sandbox.
+    rt = Runtime(datasets=datasets, commands=dict())
+    return rt.execute(*Compiler().compile(Tokenizer().tokenize(s), source=s)), rt
+
+
 @Test
 def test_tokenizer():
     ASSERT_TOKENS("", list())
@@ -206,6 +236,759 @@ def test_query():
     Query(q("+test | players | vars | attrs | metainfo | help | help metainfo | index all")).run()
 
 
+@Test
+def test_snapshot():
+    import os
+    import shutil
+    import tempfile
+    from .dataset import SNAPSHOT_NAME, load_matches
+
+    with tempfile.TemporaryDirectory() as tmp:
+        d = f"{tmp}/"
+        for g in os.listdir("klunk/samples"):
+            if g.endswith(".txt"):
+                shutil.copy(f"klunk/samples/{g}", d)
+
+        # First load parses JSON and writes the snapshot, second load reads it back.
+        cold, cold_uuids, cold_users = load_matches(d, quiet=True)
+        ASSERT_EQ(os.path.isfile(f"{d}{SNAPSHOT_NAME}"), True)
+        warm, warm_uuids, warm_users = load_matches(d, quiet=True)
+        ASSERT_EQ([m.to_row() for m in cold], [m.to_row() for m in warm])
+        ASSERT_EQ((cold_uuids, cold_users), (warm_uuids, warm_users))
+        ASSERT_EQ(warm[0].timelines.lookup.keys(), cold[0].timelines.lookup.keys())
+
+        # A group file that changed after the snapshot is re-read, without duplicating matches.
+        os.utime(f"{d}418201-418500.txt", (0, 0))
+        stale, _, _ = load_matches(d, quiet=True)
+        ASSERT_EQ([m.id for m in stale], [m.id for m in cold])
+
+        # A query from dyn.py that hasn't run yet still sees every match, not nothing.
+        from . import dyn
+
+        seen = list()
+        dyn.todos.append(seen.append)
+        pending, _, _ = load_matches(d, quiet=True)
+        ASSERT_EQ((dyn.todos, [m.id for m in pending]), ([], [m.id for m in cold]))
+        ASSERT_EQ([m.id for m in seen], [m.id for m in cold])
+
+        # With a cache dir, nothing is written next to the group files.
+        with tempfile.TemporaryDirectory() as cache:
+            os.remove(f"{d}{SNAPSHOT_NAME}")
+            before = sorted(os.listdir(d))
+            cached, _, _ = load_matches(d, quiet=True, cache_dir=f"{cache}/")
+            ASSERT_EQ(sorted(os.listdir(d)), before)
+            ASSERT_EQ(os.path.isfile(f"{cache}/{SNAPSHOT_NAME}"), True)
+            ASSERT_EQ([m.id for m in cached], [m.id for m in cold])
+
+
+@Test
+def test_store():
+    import copy
+    import pickle
+    from .extra_types import UUID, Milliseconds, Seconds
+    from .store import PLAYERS, STORE
+
+    l = sample_matches()
+    m = l[0]
+    ASSERT_EQ(type(m.duration), Milliseconds)
+    ASSERT_EQ(type(m.date), Seconds)
+    ASSERT_EQ(m.winner in [mem.uuid for mem in m.members], True)
+
+    # One UUID object per player, wherever it is used.
+    ASSERT_EQ(PLAYERS.uuid(str(m.winner)) is m.winner, True)
+    ASSERT_EQ(m.get_member(str(m.winner)).pid, m.winner_pid)
+    ASSERT_EQ(type(m.winner), UUID)
+
+    # Copies get their own row.
+    c = copy.copy(m)
+    c.duration = 1
+    ASSERT_EQ(m.duration != 1, True)
+    ASSERT_EQ(pickle.loads(pickle.dumps(m)).to_row(), m.to_row())
+
+    # Winners that aren't members are kept as-is.
+    c.winner = "deadbeef"
+    ASSERT_EQ(c.winner, "deadbeef")
+    c.winner = "__draw"
+    ASSERT_EQ(c.rql_is_draw(), True)
+
+    # Rows are reused once matches are gone.
+    rows = len(STORE.id)
+    del c, l, m
+    sample_matches()
+    ASSERT_EQ(len(STORE.id), rows)
+
+
+@Test
+def test_store_threads():
+    from threading import Thread
+    from .store import MatchStore
+
+    # Rows are handed out and given back from more than one thread.
+    store = MatchStore()
+    held: list[list[int]] = [list() for _ in range(4)]
+
+    def work(rows: list[int]):
+        for i in range(5000):
+            rows.append(store.alloc())
+            if i % 3 == 0:
+                store.release(rows.pop(0))
+
+    threads = [Thread(target=work, args=(rows,)) for rows in held]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    everything = [row for rows in held for row in rows] + store.free
+    ASSERT_EQ(sorted(everything), list(range(len(store.id))))
+
+
+@Test
+def test_lazy_timelines():
+    from . import match
+
+    l = [m for m in sample_matches() if m.valid_timelines()]
+    m = l[0]
+    ASSERT_EQ(m.timelines is m.timelines, True)
+    ASSERT_EQ(m.timelines.lookup[m.timelines[0].id][0] is m.timelines[0], True)
+    ASSERT_EQ(m.timelines[-1].id in ("rql.completed", "rql.lost"), m.rql_completed())
+
+    # Packed lookups agree with the decoded lists.
+    for split, tls in m.timelines.lookup.items():
+        ASSERT_EQ(repr(m.earliest(split)), repr(tls[0]))
+        for mem in m.members:
+            mine = [tl.time for tl in tls if tl.uuid == mem.uuid]
+            ASSERT_EQ(m.rql_split_time(split, mem.uuid), mine[0] if mine else None)
+    ASSERT_EQ(m.earliest("rql.completed"), None)
+    ASSERT_EQ(m.earliest(m.timelines[0].id, "not a player"), None)
+
+    # Decoded lists are dropped past the cache size, and decoded again on demand.
+    old_size, match.TIMELINE_CACHE_SIZE = match.TIMELINE_CACHE_SIZE, 5
+    try:
+        first = m.timelines
+        for other in l[1:10]:
+            other.timelines
+        ASSERT_EQ(len(match._timeline_cache) <= 5, True)
+        ASSERT_EQ(m.timelines is first, False)
+        ASSERT_EQ([repr(tl) for tl in m.timelines], [repr(tl) for tl in first])
+    finally:
+        match.TIMELINE_CACHE_SIZE = old_size
+
+
+@Test
+def test_timeline_cache_threads():
+    from threading import Thread
+    from . import match
+
+    l = [m for m in sample_matches() if m.valid_timelines()]
+    # Several threads at once, with entries being pushed out all the time.
+    old_size, match.TIMELINE_CACHE_SIZE = match.TIMELINE_CACHE_SIZE, 5
+    try:
+        errors = list()
+
+        def work(part):
+            try:
+                for _ in range(50):
+                    for other in part:
+                        other.timelines
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=work, args=(l[i : i + 20],)) for i in range(0, 80, 20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        ASSERT_EQ(errors, [])
+        ASSERT_EQ(len(match._timeline_cache) <= 5, True)
+    finally:
+        match.TIMELINE_CACHE_SIZE = old_size
+
+
+@Test
+def test_partitions():
+    import tempfile
+    from .partitions import ALL_SEASONS, PartitionCache, PartitionWriter, partition_seasons
+
+    l = sample_matches()
+    with tempfile.TemporaryDirectory() as tmp:
+        d = f"{tmp}/"
+        # Pretend seasons 0 and 1 were skipped at load.
+        writer = PartitionWriter(d)
+        for m in l:
+            if m.season < 2:
+                writer.add(m)
+        writer.close()
+        ASSERT_EQ(partition_seasons(d), [0, 1])
+
+        s0 = len([m for m in l if m.season == 0])
+        cache = PartitionCache(d, budget=s0)
+        ASSERT_EQ([m.id for m in cache.get(0)], [m.id for m in l if m.season == 0])
+        cache.get(1)
+        ASSERT_EQ(list(cache.loaded.keys()), [1])
+        ASSERT_EQ(cache.get(2), [])
+
+        resident = [m for m in l if m.season == 2]
+        earlier = resident[:-10]
+        everything = cache.with_all(earlier)
+        ASSERT_EQ([m.id for m in everything], [m.id for m in l[:-10]])
+        # Merged once, and that counts against the budget like a season does.
+        ASSERT_EQ(list(cache.loaded.keys()), [ALL_SEASONS])
+        ASSERT_EQ(cache.with_all(earlier) is everything, True)
+        # Live matches just go on the end.
+        ASSERT_EQ([m.id for m in cache.with_all(resident)], [m.id for m in l])
+        ASSERT_EQ([m.id for m in everything], [m.id for m in l[:-10]])
+        ASSERT_EQ(len(cache.with_season(2, resident)), len(resident))
+        cache.get(0)
+        ASSERT_EQ((list(cache.loaded.keys()), cache.merged), ([0], None))
+        ASSERT_EQ([m.id for m in cache.with_all(resident)], [m.id for m in l])
+
+    # index sN: merged and picked once, then live matches from that season go on the end.
+    s1 = [m for m in l if m.season == 1]
+    calls = list()
+
+    def ranked(part):
+        calls.append(len(part))
+        return [m for m in part if m.type == 2]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        d = f"{tmp}/"
+        writer = PartitionWriter(d)
+        for m in [m for m in l if m.season == 0] + s1[:-20]:
+            writer.add(m)
+        writer.close()
+        cache = PartitionCache(d, budget=len(l))
+        resident = s1[-20:-10]
+        picked = cache.with_season(1, resident, ranked)
+        ASSERT_EQ([m.id for m in picked], [m.id for m in s1[:-10] if m.type == 2])
+        ASSERT_EQ(cache.with_season(1, resident, ranked) is picked, True)
+        newer = cache.with_season(1, s1[-20:], ranked)
+        ASSERT_EQ(([m.id for m in newer], calls[1:]), ([m.id for m in s1 if m.type == 2], [10]))
+        ASSERT_EQ([m.id for m in picked], [m.id for m in s1[:-10] if m.type == 2])
+        # Gone with its partition.
+        cache.budget = 1
+        cache.get(0)
+        ASSERT_EQ(list(cache.picked.keys()), [])
+
+
+@Test
+def test_journal():
+    import json
+    import shutil
+    import tempfile
+    from .dataset import JOURNAL_NAME, default_groups, load_matches
+    from .journal import Journal
+
+    expected = [m.id for m in sample_matches()]
+    with tempfile.TemporaryDirectory() as tmp:
+        d = f"{tmp}/"
+        groups = default_groups("klunk/samples/")
+        for g in groups[:-1]:
+            shutil.copy(f"klunk/samples/{g}", d)
+        # The last group arrived live instead.
+        journal = Journal(f"{d}{JOURNAL_NAME}")
+        with open(f"klunk/samples/{groups[-1]}") as file:
+            journal.append([f'{json.loads(l)["match_id"]}|{l.strip()}'.encode() for l in file if l.strip() != "{}"])
+        # A crash half way through an append.
+        with open(journal.path, "ab") as file:
+            file.write(b"\xff\x00\x00\x00partial")
+
+        l, uuids, _ = load_matches(d, quiet=True)
+        ASSERT_EQ([m.id for m in l], expected)
+        ASSERT_EQ(all([mem.uuid in uuids for mem in l[-1].members]), True)
+        # Folded into the snapshot, so the next start has nothing to replay.
+        ASSERT_EQ(journal.size(), 0)
+        ASSERT_EQ([m.id for m in load_matches(d, quiet=True)[0]], expected)
+
+        journal.append([b"1|{}", b"bad message"])
+        ASSERT_EQ(journal.records(), [b"1|{}", b"bad message"])
+
+
+@Test
+def test_load_workers():
+    from .dataset import load_raw_matches
+
+    serial = sample_matches()
+    parallel = load_raw_matches("klunk/samples/", quiet=True, workers=3)
+    ASSERT_EQ([m.to_row() for m in parallel], [m.to_row() for m in serial])
+
+
+@Test
+def test_cleanup_matches():
+    from .bench import cleanup_matches_scan, tournament_matches
+    from .dataset import cleanup_matches
+
+    l = tournament_matches(2000)
+    tags = [m.tag for m in l]
+    expected = [m.tag for m in cleanup_matches_scan(l)]
+    for m, tag in zip(l, tags):
+        m.tag = tag
+    ASSERT_EQ([m.tag for m in cleanup_matches(l)], expected)
+    ASSERT_EQ(expected != tags, True)
+
+
+@Test
+def test_build_indexes():
+    from .dataset import ROOT_INDEXES, build_indexes, to_idx
+
+    l = sample_matches()
+    some = [l[5].id, l[1].id, 1]
+    defs = dict(ROOT_INDEXES, some=("Some", some))
+    idxs = build_indexes(defs, l, 1)
+    for name, (_, d) in ROOT_INDEXES.items():
+        if type(d) == str:
+            ASSERT_EQ(idxs[name], to_idx(d, l, 1))
+    ASSERT_EQ(idxs["all"] is l, True)
+    ASSERT_EQ(idxs["some"], [l[1], l[5]])
+    ASSERT_THROW(build_indexes, {"bad": ("Bad", "ranked.nope")}, l)
+
+
+@Test
+def test_apply_update():
+    from .dataset import ROOT_INDEXES, GetUserMappings, apply_update, build_indexes
+
+    l = sample_matches()
+    old = [m for m in l if m.season == l[-1].season]
+    head, live = old[: len(old) // 2], old[len(old) // 2 :]
+    datasets = root_datasets(head)
+
+    # Out of order, with a duplicate.
+    before = {name: list(d.l) for name, d in datasets.items() if name in ROOT_INDEXES}
+    updated = apply_update(datasets, list(reversed(live)) + [head[-1]], l[-1].season)
+    for name, idx in build_indexes(ROOT_INDEXES, old, l[-1].season).items():
+        ASSERT_EQ([m.id for m in updated[name].l], [m.id for m in idx])
+    ASSERT_EQ(updated["__uuids"].l, GetUserMappings(old)[0])
+    ASSERT_EQ(updated["__users"].l, GetUserMappings(old)[1])
+    # The old version is untouched.
+    for name, l2 in before.items():
+        ASSERT_EQ(datasets[name].l, l2)
+    ASSERT_EQ(datasets["__uuids"].l, GetUserMappings(head)[0])
+    ASSERT_EQ(updated["playoffs"] is datasets["playoffs"], True)
+    # Only duplicates: no new version.
+    ASSERT_EQ(apply_update(updated, head[-3:], l[-1].season) is updated, True)
+
+    # New players go on top of the old dict, which is only copied once enough of them arrived.
+    players = Dataset("UUIDs", {str(i): i for i in range(100)}, root=True)
+    first = players.updated_dict({"a": 1})
+    second = first.updated_dict({"b": 2, "0": 3})
+    ASSERT_EQ(second.l.maps[1] is players.l, True)
+    ASSERT_EQ((second.l, len(second), second.l["0"]), (players.l | {"a": 1, "b": 2, "0": 3}, 102, 3))
+    ASSERT_EQ(("b" in first.l, "a" in players.l), (False, False))
+    merged = second.updated_dict({str(i): 0 for i in range(100, 110)})
+    ASSERT_EQ((type(merged.l), len(merged.l)), (dict, 112))
+    ASSERT_EQ(type(second.merged_dict()), dict)
+    ASSERT_EQ(second.updated_dict({"c": 4}).l.maps[1] is second.l, True)
+
+
+@Test
+def test_prefix():
+    l = sample_matches()
+    head, live = l[:1000], l[1000:]
+
+    # Versions share one list that only grows, and get a list of their own when something asks.
+    first = Dataset("All", head, root=True)
+    second = first.updated(live[:10], False)
+    third = second.updated(live[10:], False)
+    ASSERT_EQ(second.prefix.shared is third.prefix.shared, True)
+    ASSERT_EQ((second.prefix._l, len(second)), (None, len(head) + 10))
+    ASSERT_EQ(second.l, head + live[:10])
+    ASSERT_EQ(first.l, head)
+    # An update that never got published is simply overwritten.
+    retry = second.updated(live[20:], False)
+    ASSERT_EQ(retry.l, head + live[:10] + live[20:])
+    ASSERT_EQ(second.l, head + live[:10])
+
+
+@Test
+def test_rollover():
+    from .dataset import ROOT_INDEXES, apply_update, build_indexes, rollover_default
+
+    l = sample_matches()
+    # Rolling over into the next season.
+    new = [m for m in l if m.season > l[-1].season - 2]
+    before = build_indexes(ROOT_INDEXES, [m for m in new if m.season < l[-1].season], l[-1].season - 1)
+    datasets = {name: Dataset(name, idx, root=True) for name, idx in before.items()}
+    datasets["__uuids"], datasets["__users"] = Dataset("UUIDs", dict(), root=True), Dataset("Users", dict(), root=True)
+    datasets["default"] = rollover_default(datasets, l[-1].season)
+    ASSERT_EQ(datasets["default"].l, [])
+    datasets = apply_update(datasets, [m for m in l if m.season == l[-1].season], l[-1].season)
+    ASSERT_EQ(datasets["default"].l, build_indexes(ROOT_INDEXES, l, l[-1].season)["default"])
+
+
+@Test
+def test_local_transport():
+    from .transport import LocalTransport
+
+    t = LocalTransport()
+    t.send(b"1|{}")
+    t.send(b"2|{}")
+    ASSERT_EQ(t.poll(1), [b"1|{}", b"2|{}"])
+    ASSERT_EQ(t.poll(0), [])
+    t.send(b"3|{}")
+    t.drain()
+    ASSERT_EQ(t.poll(0.01), [])
+
+    # A transport that's missing something fails right away, not once it's consuming.
+    from .transport import Transport
+
+    class NoPoll(Transport):
+        def connect(self):
+            pass
+
+        def drain(self):
+            pass
+
+    ASSERT_THROW(NoPoll)
+
+
+@Test
+def test_streaming():
+    l = sample_matches()
+    datasets = root_datasets(l)
+
+    def run(s):
+        return run_query(datasets, s)[0]
+
+    noff = [m for m in l if not m.is_ff]
+    village = [m for m in noff if m.seed_type == "village"]
+    ASSERT_EQ(run("index all | filter noff | filter seed_type(village) | take 3").l, village[:3])
+    ASSERT_EQ(run("index all | filter noff seed_type(village) | extract id | dropn 2").l, [m.id for m in village[2:]])
+    ASSERT_EQ(run("index all | filter noff | take 3 | sort duration").l, sorted(noff[:3], key=lambda m: m.duration))
+    ASSERT_EQ(run("index all | filter noff | take last 2").l, noff[-2:])
+
+    # Notes and errors are the same as when every command makes a list.
+    res, rt = run_query(datasets, "index all | filter season(99) noff | count")
+    ASSERT_EQ(res, None)
+    ASSERT_EQ([r for r in rt._result if r.startswith("Note: The filter")], [
+        "Note: The filter ('season', '99') matched 0 results, which might indicate an error."])
+    ASSERT_THROW(run, "index all | filter season(99) | extract id | take 3")
+    try:
+        run("index all | extract nosuch | take 3")
+    except RuntimeError as e:
+        ASSERT_EQ(type(e), RuntimeError)
+        ASSERT_EQ(str(e).startswith("While executing `extract nosuch`"), True)
+
+
+@Test
+def test_postings():
+    l = sample_matches()
+
+    # Live matches are indexed too, and older versions don't see them.
+    head = Dataset("All", l[:1000], root=True).index_players()
+    full = head.updated(l[1000:], True)
+    uuid = l[-1].members[0].uuid
+    ASSERT_EQ(full.postings.matches(full.l, [uuid]), [m for m in l if m.members.get(uuid)])
+    ASSERT_EQ(head.postings.matches(head.l, [uuid]), [m for m in l[:1000] if m.members.get(uuid)])
+    # An update that never got published leaves nothing behind for the next one.
+    head.postings.add(l[1000:1500], 1000)
+    retry = head.updated(l[1500:], True)
+    ASSERT_EQ(retry.postings.matches(retry.l, [uuid]), [m for m in l[:1000] + l[1500:] if m.members.get(uuid)])
+
+
+@Test
+def test_player_filters():
+    from .dataset import GetUserMappings
+
+    l = sample_matches()
+    # Corrupted matches, won by someone who didn't play in them.
+    lowk3y = GetUserMappings(l)[1]["lowk3y_"]
+    corrupt = [m for m in l if not m.members.get(lowk3y) and not m.rql_is_draw()][::300]
+    for m in corrupt:
+        m.winner = lowk3y
+    scan, indexed = root_datasets(l), root_datasets(l, lambda d: d.index_players())
+
+    def run(datasets, s):
+        return run_query(datasets, s)[0].l
+
+    for q in [
+        "index all | filter uuid(lowk3y_) | extract id",
+        "index all | filter winner(lowk3y_) noff | extract id",
+        "index most | filter loser(lowk3y_) | extract id",
+        "index all | filter winner(drawn match) | extract id",
+        "index all | filter uuid(lowk3y_) | extract uuid | take 1 | flatten | assign VP | index all | keepifattrcontained uuid VP",
+        "index all | filter winner(lowk3y_) | extract id",
+        "index all | filter winner(lowk3y_) | extract uuid | take 1 | flatten | assign VP | index all | keepifattrcontained winner VP | extract id",
+    ]:
+        ASSERT_EQ(run(indexed, q), run(scan, q))
+    won = run(indexed, "index all | filter winner(lowk3y_) | extract id")
+    ASSERT_EQ((len(corrupt) > 2, all([m.id in won for m in corrupt])), (True, True))
+    ASSERT_EQ(run(indexed, "index all | filter members(lowk3y_) | extract id"), run(scan, "index all | filter uuid(lowk3y_) | extract id"))
+
+
+@Test
+def test_shared_prefixes():
+    from .runtime import shared_prefixes
+
+    keys = [(c, "") for c in ["index", "filter", "to_timelines", "count", "index", "filter", "to_timelines", "average", "index", "filter", "players"]]
+    ASSERT_EQ(shared_prefixes(keys), {1, 2, 5})
+    ASSERT_EQ(shared_prefixes([("index", "['all']"), ("label", ""), ("index", "['all']"), ("label", "")]), {0})
+    ASSERT_EQ(shared_prefixes([("index", "['all']"), ("index", "['most']")]), set())
+
+
+@Test
+def test_reused_prefixes():
+    datasets = root_datasets(sample_matches())
+
+    def run(s):
+        return run_query(datasets, s)
+
+    # The same as running each part by itself.
+    parts = [
+        "index s2 | filter uuid(lowk3y_) | to_timelines | splits.get_if nether.root | count | average time",
+        "index s2 | filter uuid(lowk3y_) | to_timelines | splits.get_if story.enter_the_end | count | average time",
+        "index all | filter uuid(nobodyatall) | count",
+        "index all | filter uuid(nobodyatall) | sort duration | count",
+    ]
+    res, rt = run(" | ".join(parts))
+    ASSERT_EQ(len([x for x in rt._log if x.startswith("Reusing")]), 2)
+    separate = [run(p)[1] for p in parts]
+    ASSERT_EQ(rt._result, [r for s in separate for r in s._result])
+    ASSERT_EQ(rt.notes[1:], [n for s in separate for n in s.notes[1:]])
+    res, rt = run("index s2 | filter uuid(lowk3y_) | take 2 | index s2 | filter uuid(lowk3y_) | extract id")
+    ASSERT_EQ(res.l, run("index s2 | filter uuid(lowk3y_) | extract id")[0].l)
+    # Root indexes (season ones too) are reused as they are, postings & co. and all.
+    cloned = list()
+    clone = Dataset.clone
+    Dataset.clone = lambda d, l: cloned.append(d) or clone(d, l)
+    try:
+        res, rt = run("index s2 | count | index s2 | count")
+    finally:
+        Dataset.clone = clone
+    ASSERT_EQ(len([x for x in rt._log if x.startswith("Reusing")]), 1)
+    ASSERT_EQ([d.name for d in cloned if d.root], [])
+    # Players are made again for every part, so what one part sets on them stays there.
+    ASSERT_THROW(run, "index most | players | extract uuid nick | assign m | index most | players | applymappeddata m uuid | extract rql_dynamic | take 1 | index most | players | extract rql_dynamic | take 2")
+
+
+@Test
+def test_result_cache():
+    from . import dataset
+    from .sandbox import RESULT_CACHE, ResultCache
+
+    def run(s):
+        q = Query(s, no_mq=True)
+        return q.run(), q._result
+
+    first, _ = run("index all | filter uuid(lowk3y_) | extract id")
+    hits, misses = RESULT_CACHE.hits, RESULT_CACHE.misses
+    again, _ = run("index   all|filter uuid(lowk3y_)  | extract id")
+    ASSERT_EQ(again is first, True)
+    ASSERT_EQ((RESULT_CACHE.hits, RESULT_CACHE.misses), (hits + 1, misses))
+    # Can't be cached.
+    run("index all | randomselect 5")
+    run("index all | randomselect 5")
+    ASSERT_EQ((RESULT_CACHE.hits, RESULT_CACHE.misses), (hits + 1, misses))
+    # The caller can add to _result without changing the cached one.
+    _, res = run("index all | take 5 | vars")
+    res.append("extra")
+    ASSERT_EQ(run("index all | take 5 | vars")[1], res[:-1])
+    # Case isn't folded: another entry, with the same result since names are looked up without case.
+    misses = RESULT_CACHE.misses
+    cased, _ = run("index all | filter uuid(LowK3y_) | extract id")
+    ASSERT_EQ((cased is first, cased.l), (False, first.l))
+    ASSERT_EQ(RESULT_CACHE.misses, misses + 1)
+    ASSERT_THROW(run, "INDEX all | filter uuid(lowk3y_) | extract id")
+
+    # New matches -> new version -> nothing is cached any more.
+    v = dataset.current_version()
+    dataset.publish(dataset.DatasetVersion(v.number + 1, v.datasets, v.season))
+    after, _ = run("index all | filter uuid(lowk3y_) | extract id")
+    ASSERT_EQ(after is first, False)
+    ASSERT_EQ(after.l, first.l)
+
+    cache = ResultCache(10)
+    rt = Runtime(dataset.current_version().datasets, dict())
+    for i in range(4):
+        cache.put(str(i), 1, rt, Dataset("x", [i, i]))
+    ASSERT_EQ(list(cache.entries.keys()), ["1", "2", "3"])
+    ASSERT_EQ(cache.size(), 9)
+    # Putting a key again replaces its entry.
+    cache.put("3", 1, rt, Dataset("x", [3]))
+    ASSERT_EQ((list(cache.entries.keys()), cache.size()), (["1", "2", "3"], 8))
+    cache.put("big", 1, rt, Dataset("x", list(range(20))))
+    ASSERT_EQ(cache.get("big", 1), None)
+    ASSERT_EQ(cache.get("1", 2), None)
+    ASSERT_EQ((len(cache.entries), cache.size()), (0, 0))
+
+
+@Test
+def test_extractors():
+    from operator import attrgetter
+    from .runtime import EXTRACTORS, DirectExtractor, SmartExtractor
+
+    l = sample_matches()
+    ASSERT_EQ(type(DirectExtractor(l[0], "duration")), attrgetter)
+    ASSERT_EQ(DirectExtractor(l[0], "duration") is DirectExtractor(l[1], "duration"), True)
+    ASSERT_EQ(EXTRACTORS[(type(l[0]), "duration", ())] is not None, True)
+    # Comes from the members, which depends on the match.
+    ASSERT_EQ(DirectExtractor(l[0], "elo"), None)
+    ASSERT_EQ(DirectExtractor(l[0], "_row"), None)
+
+    for attribute in ["duration", "winner", "seed_type", "completed", "loser", "members", "user", "elo", ("split_time", f"story.enter_the_end,{l[0].winner}")]:
+        extractor = SmartExtractor(l[0], attribute)
+        name, args = attribute if isinstance(attribute, tuple) else (attribute, None)
+        ASSERT_EQ([extractor(m) for m in l], [m.extract(name, *([] if args is None else args.split(","))) for m in l])
+    mem = l[0].members[0]
+    ASSERT_EQ(SmartExtractor(mem, "elo")(mem), mem.elo)
+
+    # Paths.
+    ASSERT_EQ([SmartExtractor(l[0], "members.user")(m) for m in l], [[mem.user for mem in m.members] for m in l])
+    ASSERT_THROW(SmartExtractor, l[0], "nosuch.user")
+
+
+@Test
+def test_sort_orders():
+    l = sample_matches()
+    head = Dataset("All", l[:1500], root=True).keep_orders()
+    for attribute in ["duration", "date", "id"]:
+        for reverse in [False, True]:
+            expected = sorted(l[:1500], key=lambda m: m.extract(attribute), reverse=reverse)
+            ASSERT_EQ(head.orders.sorted(head.l, attribute, reverse), expected)
+    noff = [m for m in head.l if not m.is_ff]
+    ASSERT_EQ(head.orders.sorted(noff, "duration", True), sorted(noff, key=lambda m: m.duration, reverse=True))
+    # Out of index order, too small a part, or not part of it at all.
+    ASSERT_EQ(head.orders.sorted(list(reversed(noff)), "duration", False), None)
+    ASSERT_EQ(head.orders.sorted(noff[:10], "duration", False), None)
+    ASSERT_EQ(head.orders.sorted(l[500:], "duration", False), None)
+    ASSERT_EQ(head.orders.sorted(noff, "seed_type", False), None)
+
+    # Live matches are merged in; the old version keeps its own orders.
+    full = head.updated(l[1500:], True)
+    fresh = Dataset("All", l, root=True).keep_orders()
+    for key in head.orders.orders.keys():
+        ASSERT_EQ(full.orders.order(*key).positions, fresh.orders.order(*key).positions)
+    ASSERT_EQ(head.orders.sorted(noff, "duration", True), sorted(noff, key=lambda m: m.duration, reverse=True))
+    ASSERT_EQ(full.orders.top("date", 3, True, False), sorted(l, key=lambda m: m.date)[-3:])
+
+
+@Test
+def test_sorted_take():
+    from .match import QueryMatch
+
+    datasets = root_datasets(sample_matches())
+
+    def run(s):
+        res, rt = run_query(datasets, s)
+        # players makes new Players every time.
+        return [x if type(x) is QueryMatch else x.uuid for x in res.l], rt.notes
+
+    # Lots of ties (seed_type, type) and Nones (bastion, elo). `slice 0:` keeps take from being fused.
+    for q in ["index all | {} duration", "index all | {} seed_type", "index all | {} bastion", "index all | {} type", "index s2 | players | {} elo"]:
+        for sort in ["sort", "rsort"]:
+            for take in ["1", "7", "5000", "last 1", "last 7", "last 5000"]:
+                ASSERT_EQ(run(f"{q.format(sort)} | take {take}"), run(f"{q.format(sort)} | slice 0: | take {take}"))
+
+
+@Test
+def test_selection():
+    from .dataset import Selection
+
+    datasets = root_datasets(sample_matches(), lambda d: d.keep_orders())
+
+    def run(s):
+        res, rt = run_query(datasets, s)
+        return res, rt._result
+
+    # Only looks the matches up when something needs them.
+    root = datasets["all"]
+    keep = [m for m in root.l if not m.is_ff]
+    sel = Selection(root, root.orders.positions(keep))
+    ASSERT_EQ(len(sel), len(keep))
+    ASSERT_EQ(sel._l, None)
+    ASSERT_EQ(sel.l, keep)
+    ASSERT_EQ(run("index all | filter noff | between duration 600000 900000 | count")[1], run("index all | filter noff | between duration 600000 900000 | slice 0: | count")[1])
+    # Nor does sort | take, which goes through the root's order with the positions.
+    looked = list()
+    whole = Selection.l
+    Selection.l = property(lambda s: looked.append(s) or whole.fget(s), whole.fset)
+    try:
+        run("index all | filter noff | sort duration | take 5")
+    finally:
+        Selection.l = whole
+    ASSERT_EQ(looked, [])
+    # `slice 0:` makes a list first, so these are what a list gives.
+    for q in ["filter noff", "filter noff | drop type 1", "filter season(1) | take 5000", "filter nodecay", "filter winner(nobodyatall)"]:
+        for tail in ["sort duration", "rsort date", "sort id | take 7", "rsort duration | take last 7", "sort seed_type | take 3"]:
+            a, b = run(f"index all | {q} | {tail}"), run(f"index all | {q} | slice 0: | {tail}")
+            ASSERT_EQ(a[0].l, b[0].l)
+            ASSERT_EQ(a[1], b[1])
+
+
+@Test
+def test_bitmaps():
+    from operator import attrgetter
+    from .bitmaps import Bitmaps, to_bits, to_mask
+
+    ASSERT_EQ(to_bits(bytearray([1, 0, 1, 1, 0, 0])), 0b1101)
+    ASSERT_EQ(to_mask(0b1101), bytes([1, 0, 1, 1]))
+    ASSERT_EQ(to_bits(bytearray()), 0)
+
+    l = sample_matches()
+    head = Bitmaps(l[:1500])
+    for attribute in ["is_ff", "season", "seed_type", "bastion", "tag"]:
+        get = attrgetter(attribute)
+        for value in set([get(m) for m in l]) | {"nosuch"}:
+            ASSERT_EQ(head.matches(head.bits(attribute, value, get)), [m for m in l[:1500] if get(m) == value])
+    ASSERT_EQ(head.bits("members", None, attrgetter("members")), None)
+    # Live matches are added on; the old version keeps its own.
+    full = head.updated(l, 1500)
+    ASSERT_EQ(full.matches(full.bits("season", 2, attrgetter("season"))), [m for m in l if m.season == 2])
+    ASSERT_EQ(head.matches(head.bits("season", 2, attrgetter("season"))), [m for m in l[:1500] if m.season == 2])
+
+
+@Test
+def test_bitmap_filters():
+    l = sample_matches()
+
+    def run(s, bitmaps):
+        # New datasets every time, so each query works the bitmaps out for itself.
+        res, rt = run_query(root_datasets(l, lambda d: d.keep_bitmaps() if bitmaps else d), s)
+        return None if res is None else res.l, rt._result, rt.notes
+
+    # `slice 0:` first makes filter go row by row.
+    for q in ["filter noff nodecay", "filter season(2) seed_type(village) noabnormal", "filter completed bastion(bridge)", "filter type(2) winner(nobodyatall)", "filter season(99) noff", "filter noff uuid(lowk3y_) season(2)"]:
+        for tail in ["count", "take 5", "slice 0: | count"]:
+            ASSERT_EQ(run(f"index all | {q} | {tail}", True), run(f"index all | {q} | {tail}", False))
+        ASSERT_EQ(run(f"index all | {q} | count", True), run(f"index all | slice 0: | {q} | count", True))
+
+
+@Test
+def test_season_indexes():
+    l = sample_matches()
+    seasons = sorted(set([m.season for m in l]))
+    # Some of the newest season is already in, the rest arrives live.
+    cut = [m.season for m in l].index(seasons[-1]) + 100
+    head = Dataset("Most", l[:cut], root=True).index_players()
+    oldest = seasons[0]
+    ASSERT_EQ(head.season_index(99), None)
+    first = head.season_index(oldest)
+    ASSERT_EQ(first.l, [m for m in l[:cut] if m.season == oldest])
+    ASSERT_EQ(first.postings is not None and first.orders is None, True)
+    ASSERT_EQ(head.season_index(oldest) is first, True)
+    # Live matches are added to every season they're from; the old version keeps its own.
+    full = head.updated(l[cut:], False)
+    for season in seasons:
+        ASSERT_EQ(full.season_index(season).l, [m for m in l if m.season == season])
+    ASSERT_EQ(head.season_index(oldest).l, first.l)
+    # Or starts a new one.
+    older = Dataset("Most", l[: cut - 100], root=True)
+    older.season_index(oldest)
+    ASSERT_EQ(older.updated(l[cut - 100 :], False).season_index(seasons[-1]).l, [m for m in l if m.season == seasons[-1]])
+
+
+@Test
+def test_season_index_queries():
+    l = sample_matches()
+    datasets = root_datasets(l)
+
+    def run(s):
+        res, rt = run_query(datasets, s)
+        return None if res is None else res.l, rt._result, rt.notes
+
+    for season in sorted(set([m.season for m in l])) + [99]:
+        ASSERT_EQ(run(f"index s{season} | count"), run(f"index most | filter season({season}) | count"))
+        ASSERT_EQ(run(f"index s{season} | sort duration | take 3"), run(f"index most | filter season({season}) | sort duration | take 3"))
+
+
 @Test
 def test_utils():
     ASSERT_EQ(split_before("", lambda c: c == "q"), ("", ""))
@@ -244,5 +1027,16 @@ def todo_tests():
 
 
 if __name__ == "__main__":
+    import traceback
+
+    # Keep going after a failure, so one broken test doesn't hide the rest.
+    failed = list()
     for test_f in test_registry:
-        test_f()
+        try:
+            test_f()
+        except Exception:
+            traceback.print_exc()
+            failed.append(test_f.__name__)
+    if failed:
+        print(f"{len(failed)} of {len(test_registry)} tests failed: {', '.join(failed)}")
+        sys.exit(1)
@@ -0,0 +1,97 @@
+"""
+Where PikaConnection gets its messages from. Each message is one match as
+"match_id|json" (see parse_messages).
+
+PikaTransport is the real thing (the rql-ipc queue on a local RabbitMQ).
+LocalTransport is an in-process stand-in, for tests and benchmarks that
+shouldn't need a server running.
+"""
+import queue
+from abc import ABC, abstractmethod
+
+
+class Transport(ABC):
+    @abstractmethod
+    def connect(self):
+        ...
+
+    @abstractmethod
+    def drain(self):
+        # Throw away whatever is waiting (anything from before we started).
+        ...
+
+    @abstractmethod
+    def poll(self, timeout: float) -> list[bytes]:
+        # Waits up to timeout seconds for messages, returns whatever arrived (possibly nothing).
+        ...
+
+    def close(self):
+        pass
+
+
+class PikaTransport(Transport):
+    def __init__(self, host="localhost", queue_name="rql-ipc"):
+        self.host = host
+        self.queue_name = queue_name
+        self.connection = None
+        self.channel = None
+        self.recv: list[bytes] = list()
+
+    def callback(self, ch, method, __1__, body):
+        print(f"received body with len {len(body)} (first bit: {body[0:24]})")
+        self.recv.append(body)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    def connect(self):
+        import pika
+
+        self.connection = None
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host))
+        self.channel = self.connection.channel()
+        self.channel.queue_declare(queue=self.queue_name)
+        self.channel.basic_consume(on_message_callback=lambda *args: self.callback(*args), queue=self.queue_name)
+
+    def drain(self):
+        assert self.connection is not None
+        self.connection.process_data_events(0)
+        self.recv.clear()
+
+    def poll(self, timeout: float) -> list[bytes]:
+        assert self.connection is not None
+        self.connection.process_data_events(time_limit=timeout)
+        recv, self.recv = self.recv, list()
+        return recv
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class LocalTransport(Transport):
+    """
+    Messages go in with send() (from any thread) and come out of poll().
+    """
+
+    def __init__(self):
+        self.queue: queue.Queue[bytes] = queue.Queue()
+
+    def send(self, body: bytes):
+        self.queue.put(body)
+
+    def connect(self):
+        pass
+
+    def drain(self):
+        self.poll(0)
+
+    def poll(self, timeout: float) -> list[bytes]:
+        res = list()
+        try:
+            if timeout > 0:
+                res.append(self.queue.get(timeout=timeout))
+            while True:
+                res.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return res